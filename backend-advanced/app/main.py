@@ -253,8 +253,9 @@ def gmail_batch_classify(email: str = Body(..., embed=True), label: str = Body("
             results.append({"id": m["id"], "score": sc["score"], "reasons": sc["reasons"], "action": action})
 
         if not dry_run:
-            for mid in to_quarantine:
-                svc.users().messages().modify(userId="me", id=mid, body={"addLabelIds":[qid], "removeLabelIds":["INBOX"]}).execute()
+            # batchModify takes up to 1000 ids per call
+            for i in range(0, len(to_quarantine), 1000):
+                svc.users().messages().batchModify(userId="me", body={"ids": to_quarantine[i:i+1000], "addLabelIds":[qid], "removeLabelIds":["INBOX"]}).execute()
 
         return {"email": email, "label": label, "threshold": quarantine_threshold, "dry_run": dry_run, "count": len(results), "items": results}
     except Exception as e:
@@ -4,6 +4,8 @@ from pydantic import BaseModel
 from typing import List, Optional
 from dotenv import load_dotenv
 import os, datetime
+from bisect import bisect_right
+from matcher import KeywordMatcher
 
 load_dotenv()
 API_KEY = os.getenv("API_KEY")
@@ -32,14 +34,27 @@ class ClassificationResult(BaseModel):
 def health_check():
     return {"status": "ok", "timestamp": datetime.datetime.utcnow().isoformat()}
 
+SPAM_KEYWORDS = ["buy now", "free", "limited offer"]
+SPAM_MATCHER = KeywordMatcher((k, k) for k in SPAM_KEYWORDS)
+
+def spam_flags(texts: List[str]) -> List[bool]:
+    """Which texts contain a spam keyword, found in one automaton pass over all of them.
+
+    Texts are joined with \\0, which no keyword contains, so no match spans two texts.
+    """
+    flags = [False] * len(texts)
+    starts, pos = [], 0
+    for t in texts:
+        starts.append(pos)
+        pos += len(t) + 1
+    for start, _, _ in SPAM_MATCHER.finditer("\0".join(texts)):
+        flags[bisect_right(starts, start) - 1] = True
+    return flags
+
 @app.post("/classify_batch", response_model=List[ClassificationResult], dependencies=[Depends(verify_api_key)])
 def classify_batch(emails: List[Email]):
-    results = []
-    for email in emails:
-        text = (email.subject + " " + email.body).lower()
-        classification = "spam" if any(k in text for k in ["buy now", "free", "limited offer"]) else "inbox"
-        results.append({"id": email.id, "classification": classification})
-    return results
+    flags = spam_flags([(e.subject + " " + e.body).lower() for e in emails])
+    return [{"id": e.id, "classification": "spam" if spam else "inbox"} for e, spam in zip(emails, flags)]
 
 @app.post("/quarantine", dependencies=[Depends(verify_api_key)])
 def quarantine_email(email_id: str):
@@ -0,0 +1,111 @@
+"""Benchmark of message metadata fetching against a local fake Gmail.
+
+Fetches the metadata of `--messages` messages three ways, through the real GmailClient:
+one `messages.get` at a time (what batch-classify did before batching), the same gets issued
+concurrently (bounded by the per-user semaphore), and `get_metadata_batch`, which sends them
+`--chunk-size` to a multipart batch request. The fake answers over an in-process
+httpx.MockTransport after `--latency` ms per HTTP exchange (plus `--item-cost` ms per message
+in a batch), standing in for the round trip to Gmail, and counts the exchanges:
+
+    python -m app.bench --messages 500 --latency 40
+"""
+import argparse, asyncio, json, re, time
+from typing import Any, Dict, List
+
+import httpx
+
+from .gmail_client import GmailClient
+
+HEADERS = ["From", "Subject", "List-Unsubscribe", "Date"]
+
+
+def fake_message(i: int) -> Dict[str, Any]:
+    return {"id": f"m{i}", "threadId": f"t{i}", "snippet": f"snippet of message {i}", "internalDate": str(1700000000000 + i),
+            "payload": {"headers": [{"name": "From", "value": f"Sender {i} <s{i}@example{i % 7}.com>"},
+                                    {"name": "Subject", "value": f"Message number {i}"}]}}
+
+
+class FakeGmail:
+    """Answers messages.list, messages.get and batched gets for `count` messages; counts HTTP exchanges."""
+
+    def __init__(self, count: int, latency: float, item_cost: float):
+        self.messages = {f"m{i}": fake_message(i) for i in range(count)}
+        self.latency = latency
+        self.item_cost = item_cost
+        self.exchanges = 0
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        self.exchanges += 1
+        path = request.url.path
+        if path.endswith("/batch/gmail/v1"):
+            boundary = request.headers["content-type"].split("boundary=", 1)[1]
+            items = re.findall(r"Content-ID: <([^>]+)>\r\n\r\nGET /gmail/v1/users/me/messages/([^?\s]+)", request.content.decode())
+            await asyncio.sleep(self.latency + self.item_cost * len(items))
+            parts = []
+            for cid, mid in items:
+                msg = self.messages.get(mid)
+                status, body = ("200 OK", json.dumps(msg)) if msg else ("404 Not Found", '{"error": "not found"}')
+                parts.append(f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{cid}>\r\n\r\n"
+                             f"HTTP/1.1 {status}\r\nContent-Type: application/json\r\n\r\n{body}\r\n")
+            return httpx.Response(200, headers={"content-type": f"multipart/mixed; boundary={boundary}"},
+                                  content="".join(parts) + f"--{boundary}--\r\n")
+        await asyncio.sleep(self.latency + self.item_cost)
+        if path.endswith("/messages"):
+            return httpx.Response(200, json={"messages": [{"id": mid} for mid in self.messages]})
+        msg = self.messages.get(path.rsplit("/", 1)[-1])
+        return httpx.Response(200, json=msg) if msg else httpx.Response(404, json={"error": "not found"})
+
+
+async def run(messages: int, latency: float, item_cost: float, chunk_size: int, concurrency: int) -> List[Dict[str, Any]]:
+    fake = FakeGmail(messages, latency / 1000, item_cost / 1000)
+
+    async def token(email: str, force: bool = False) -> str:
+        return "token"
+
+    gmail = GmailClient(token, per_user_concurrency=concurrency, transport=httpx.MockTransport(fake.handle))
+    email = "bench@example.com"
+
+    async def sequential(ids):
+        return [await gmail.get_metadata(email, mid, HEADERS) for mid in ids]
+
+    async def concurrent(ids):
+        return await asyncio.gather(*[gmail.get_metadata(email, mid, HEADERS) for mid in ids])
+
+    async def batched(ids):
+        return await gmail.get_metadata_batch(email, ids, HEADERS, chunk_size=chunk_size)
+
+    rows, expected = [], None
+    try:
+        for name, fetch in (("sequential", sequential), (f"concurrent ({concurrency})", concurrent), (f"batched ({chunk_size})", batched)):
+            fake.exchanges = 0
+            start = time.perf_counter()
+            ids = [m["id"] for m in (await gmail.list_messages(email, max_results=messages))["messages"]]
+            found = await fetch(ids)
+            elapsed = time.perf_counter() - start
+            if expected is None:
+                expected = found
+            elif found != expected:
+                raise SystemExit(f"{name}: results differ from a one-by-one fetch")
+            rows.append({"mode": name, "exchanges": fake.exchanges, "seconds": elapsed})
+    finally:
+        await gmail.aclose()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n", 1)[0])
+    parser.add_argument("--messages", type=int, default=500)
+    parser.add_argument("--latency", type=float, default=40.0, help="ms per HTTP exchange")
+    parser.add_argument("--item-cost", type=float, default=0.2, help="ms per message served")
+    parser.add_argument("--chunk-size", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=4, help="per-user connection limit")
+    args = parser.parse_args()
+    rows = asyncio.run(run(args.messages, args.latency, args.item_cost, args.chunk_size, args.concurrency))
+    base = rows[0]["seconds"]
+    print(f"{args.messages} messages, {args.latency:g} ms per exchange")
+    for r in rows:
+        print(f"{r['mode']:<16} {r['exchanges']:>5} exchanges {r['seconds']:>8.2f}s {base / r['seconds']:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
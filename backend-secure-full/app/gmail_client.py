@@ -0,0 +1,254 @@
+"""Async Gmail REST client sharing one httpx connection pool across all users.
+
+Every call for a user goes through that user's semaphore, so a slow mailbox can only
+occupy `per_user_concurrency` connections while other tenants keep making progress. Calls are
+metered in quota units by an optional RateLimiter, and throttled (429, rate-limit 403) or
+failed (5xx, network) requests are retried with jittered exponential backoff, honoring
+Retry-After.
+"""
+import asyncio, json, uuid
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+import httpx
+
+from .ratelimit import QUOTA_UNITS, RateLimiter, backoff, retry_after
+
+GMAIL_API = "https://gmail.googleapis.com/gmail/v1/users/me"
+GMAIL_BATCH_URL = "https://gmail.googleapis.com/batch/gmail/v1"
+
+# (email, force_refresh) -> bearer token
+TokenProvider = Callable[[str, bool], Awaitable[str]]
+
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = ("rateLimitExceeded", "userRateLimitExceeded")
+
+
+class GmailError(Exception):
+    def __init__(self, status: int, detail: str, retry_after: Optional[float] = None):
+        super().__init__(f"Gmail API error {status}: {detail}")
+        self.status = status
+        self.detail = detail
+        self.retry_after = retry_after
+
+    @property
+    def throttled(self) -> bool:
+        return self.status == 429 or (self.status == 403 and any(r in self.detail for r in RATE_LIMIT_REASONS))
+
+    @property
+    def retryable(self) -> bool:
+        return self.throttled or self.status in RETRY_STATUSES
+
+
+class GmailClient:
+    def __init__(self, token_provider: TokenProvider, max_connections: int = 100, per_user_concurrency: int = 4, timeout: float = 20.0,
+                 limiter: Optional[RateLimiter] = None, max_retries: int = 5, retry_base: float = 0.5, retry_cap: float = 32.0,
+                 transport: Optional[httpx.AsyncBaseTransport] = None):
+        self._token_provider = token_provider
+        self._limiter = limiter
+        self.max_retries = max_retries
+        self.retry_base = retry_base
+        self.retry_cap = retry_cap
+        self.metrics: Dict[str, float] = dict.fromkeys(
+            ["requests", "retries", "throttled", "server_errors", "network_errors", "limiter_waits", "limiter_wait_seconds"], 0)
+        self._limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self._timeout = timeout
+        self._transport = transport  # e.g. a fake Gmail for app/bench.py; None: the network
+        self._per_user = per_user_concurrency
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self._http: Optional[httpx.AsyncClient] = None
+
+    @property
+    def http(self) -> httpx.AsyncClient:
+        if self._http is None or self._http.is_closed:
+            self._http = httpx.AsyncClient(limits=self._limits, timeout=self._timeout, transport=self._transport)
+        return self._http
+
+    async def aclose(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+    def _semaphore(self, email: str) -> asyncio.Semaphore:
+        sem = self._semaphores.get(email)
+        if sem is None:
+            sem = self._semaphores[email] = asyncio.Semaphore(self._per_user)
+        return sem
+
+    def _record(self, err: GmailError):
+        if err.throttled:
+            self.metrics["throttled"] += 1
+        elif err.status >= 500:
+            self.metrics["server_errors"] += 1
+
+    def _retry_delay(self, err: GmailError, attempt: int) -> float:
+        return err.retry_after if err.retry_after is not None else backoff(attempt, self.retry_base, self.retry_cap)
+
+    async def _send(self, email: str, method: str, url: str, units: int = 1, **kwargs) -> httpx.Response:
+        """Send one authorized request, refreshing the token once if Gmail rejects it.
+
+        `units` is the call's Gmail quota cost. Throttled, 5xx and network failures are retried
+        up to `max_retries` times before the last error is raised as a GmailError; so is a
+        Retry-After longer than `retry_cap`, rather than holding the request that long.
+        """
+        extra = kwargs.pop("headers", {})
+        attempt = 0
+        while True:
+            if self._limiter is not None:
+                waited = await self._limiter.acquire(email, units)
+                if waited:
+                    self.metrics["limiter_waits"] += 1
+                    self.metrics["limiter_wait_seconds"] += waited
+            async with self._semaphore(email):
+                self.metrics["requests"] += 1
+                try:
+                    token = await self._token_provider(email, False)
+                    r = await self.http.request(method, url, headers={"Authorization": f"Bearer {token}", **extra}, **kwargs)
+                    if r.status_code == 401:
+                        token = await self._token_provider(email, True)
+                        r = await self.http.request(method, url, headers={"Authorization": f"Bearer {token}", **extra}, **kwargs)
+                    err = GmailError(r.status_code, r.text, retry_after(r.headers.get("retry-after"))) if r.status_code >= 400 else None
+                except httpx.TransportError as e:
+                    self.metrics["network_errors"] += 1
+                    err = GmailError(503, f"{type(e).__name__}: {e}")
+            if err is None:
+                return r
+            self._record(err)
+            if not err.retryable or attempt >= self.max_retries or (err.retry_after or 0) > self.retry_cap:
+                raise err
+            self.metrics["retries"] += 1
+            await asyncio.sleep(self._retry_delay(err, attempt))
+            attempt += 1
+
+    async def _call(self, email: str, method: str, path: str, units: int, params: Optional[dict] = None, body: Optional[dict] = None) -> Dict[str, Any]:
+        r = await self._send(email, method, f"{GMAIL_API}{path}", units=units, params=params, json=body)
+        return r.json() if r.content else {}
+
+    # ---- Endpoints ----
+    async def get_profile(self, email: str) -> Dict[str, Any]:
+        return await self._call(email, "GET", "/profile", QUOTA_UNITS["getProfile"])
+
+    async def list_labels(self, email: str) -> List[Dict[str, Any]]:
+        return (await self._call(email, "GET", "/labels", QUOTA_UNITS["labels.list"])).get("labels", [])
+
+    async def create_label(self, email: str, name: str) -> Dict[str, Any]:
+        return await self._call(email, "POST", "/labels", QUOTA_UNITS["labels.create"], body={"name": name, "labelListVisibility": "labelShow", "messageListVisibility": "show"})
+
+    async def watch(self, email: str, topic_name: str, label_ids: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Start or renew push notifications to a Pub/Sub topic; returns {"historyId", "expiration"}."""
+        body = {"topicName": topic_name, "labelIds": label_ids, "labelFilterBehavior": "include" if label_ids else None}
+        return await self._call(email, "POST", "/watch", QUOTA_UNITS["watch"], body={k: v for k, v in body.items() if v})
+
+    async def stop_watch(self, email: str) -> Dict[str, Any]:
+        return await self._call(email, "POST", "/stop", QUOTA_UNITS["stop"])
+
+    async def list_messages(self, email: str, label_ids: Optional[List[str]] = None, q: Optional[str] = None, max_results: Optional[int] = None, page_token: Optional[str] = None) -> Dict[str, Any]:
+        params = {"labelIds": label_ids, "q": q, "maxResults": max_results, "pageToken": page_token}
+        return await self._call(email, "GET", "/messages", QUOTA_UNITS["messages.list"], params={k: v for k, v in params.items() if v})
+
+    async def list_history(self, email: str, start_history_id: str, label_id: Optional[str] = None, history_types: Optional[List[str]] = None, page_token: Optional[str] = None) -> Dict[str, Any]:
+        params = {"startHistoryId": start_history_id, "labelId": label_id, "historyTypes": history_types, "pageToken": page_token, "maxResults": 500}
+        return await self._call(email, "GET", "/history", QUOTA_UNITS["history.list"], params={k: v for k, v in params.items() if v})
+
+    async def added_message_ids(self, email: str, start_history_id: str, label: Optional[str] = None) -> Tuple[List[str], str]:
+        """Ids of messages added to `label` since `start_history_id` (oldest first) and the latest historyId.
+
+        Raises GmailError with status 404 when the start id is too old for Gmail to replay.
+        """
+        ids: Dict[str, None] = {}
+        history_id, page_token = start_history_id, None
+        while True:
+            res = await self.list_history(email, start_history_id, label_id=label, history_types=["messageAdded"], page_token=page_token)
+            for record in res.get("history", []):
+                for added in record.get("messagesAdded", []):
+                    msg = added.get("message", {})
+                    if not label or label in msg.get("labelIds", [label]):
+                        ids[msg["id"]] = None
+            history_id = res.get("historyId", history_id)
+            page_token = res.get("nextPageToken")
+            if not page_token:
+                return list(ids), history_id
+
+    async def get_metadata(self, email: str, msg_id: str, headers: List[str]) -> Dict[str, Any]:
+        return await self._call(email, "GET", f"/messages/{msg_id}", QUOTA_UNITS["messages.get"], params={"format": "metadata", "metadataHeaders": headers})
+
+    async def modify(self, email: str, msg_id: str, add: Optional[List[str]] = None, remove: Optional[List[str]] = None) -> Dict[str, Any]:
+        return await self._call(email, "POST", f"/messages/{msg_id}/modify", QUOTA_UNITS["messages.modify"], body={"addLabelIds": add or [], "removeLabelIds": remove or []})
+
+    async def batch_modify(self, email: str, msg_ids: List[str], add: Optional[List[str]] = None, remove: Optional[List[str]] = None):
+        """Relabel many messages with messages.batchModify, at most 1000 ids per call."""
+        for i in range(0, len(msg_ids), 1000):
+            await self._call(email, "POST", "/messages/batchModify", QUOTA_UNITS["messages.batchModify"], body={"ids": msg_ids[i:i + 1000], "addLabelIds": add or [], "removeLabelIds": remove or []})
+
+    async def get_metadata_batch(self, email: str, msg_ids: List[str], headers: List[str], chunk_size: int = 50) -> List[Union[Dict[str, Any], GmailError]]:
+        """Fetch metadata for many messages via the batch endpoint, one HTTP exchange per chunk.
+
+        Returns one entry per id, in order: the message resource, or the GmailError for that item.
+        Items that were throttled or failed transiently inside a batch are re-batched and retried.
+        A chunk whose whole exchange failed (already retried by `_send`) gets its error for every
+        id in it, without costing the other chunks their results.
+        """
+        query = str(httpx.QueryParams({"format": "metadata", "metadataHeaders": headers}))
+        found: List[Union[Dict[str, Any], GmailError]] = [GmailError(502, "not fetched")] * len(msg_ids)
+        todo = list(range(len(msg_ids)))
+        for attempt in range(self.max_retries + 1):
+            chunks = [todo[i:i + chunk_size] for i in range(0, len(todo), chunk_size)]
+            parts = await asyncio.gather(*[self._batch_get(email, [msg_ids[j] for j in chunk], query) for chunk in chunks], return_exceptions=True)
+            exhausted = set()
+            for chunk, part in zip(chunks, parts):
+                if isinstance(part, BaseException):
+                    if not isinstance(part, GmailError):
+                        raise part
+                    part = [part] * len(chunk)
+                    exhausted.update(chunk)
+                for j, item in zip(chunk, part):
+                    found[j] = item
+            failed = [j for j in todo if isinstance(found[j], GmailError) and found[j].retryable and j not in exhausted]
+            for j in failed:
+                self._record(found[j])
+            if not failed or attempt == self.max_retries:
+                break
+            self.metrics["retries"] += len(failed)
+            await asyncio.sleep(max(self._retry_delay(found[j], attempt) for j in failed))
+            todo = failed
+        return found
+
+    async def _batch_get(self, email: str, msg_ids: List[str], query: str) -> List[Union[Dict[str, Any], GmailError]]:
+        boundary = f"batch_{uuid.uuid4().hex}"
+        body = "".join(
+            f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <item{i}>\r\n\r\n"
+            f"GET /gmail/v1/users/me/messages/{mid}?{query}\r\n\r\n"
+            for i, mid in enumerate(msg_ids)
+        ) + f"--{boundary}--\r\n"
+        r = await self._send(email, "POST", GMAIL_BATCH_URL, units=QUOTA_UNITS["messages.get"] * len(msg_ids), content=body.encode(), headers={"Content-Type": f"multipart/mixed; boundary={boundary}"})
+        found = parse_batch_response(r.headers.get("content-type", ""), r.text)
+        return [found.get(f"item{i}", GmailError(502, "missing batch item")) for i in range(len(msg_ids))]
+
+
+def parse_batch_response(content_type: str, text: str) -> Dict[str, Union[Dict[str, Any], GmailError]]:
+    """Split a multipart/mixed batch response into {content-id: resource or GmailError}."""
+    boundary = content_type.split("boundary=", 1)[-1].strip().strip('"')
+    out: Dict[str, Union[Dict[str, Any], GmailError]] = {}
+    for part in text.replace("\r\n", "\n").split(f"--{boundary}"):
+        part = part.strip()
+        if not part or part == "--":
+            continue
+        outer, _, inner = part.partition("\n\n")
+        cid = ""
+        for line in outer.split("\n"):
+            name, _, value = line.partition(":")
+            if name.strip().lower() == "content-id":
+                cid = value.strip().strip("<>").replace("response-", "", 1)
+        head, _, payload = inner.partition("\n\n")
+        try:
+            status = int(head.split("\n", 1)[0].split(" ")[1])
+        except (IndexError, ValueError):
+            status = 502
+        if status >= 400:
+            out[cid] = GmailError(status, payload.strip())
+            continue
+        try:
+            out[cid] = json.loads(payload) if payload.strip() else {}
+        except ValueError:
+            out[cid] = GmailError(502, "invalid JSON in batch item")
+    return out
@@ -0,0 +1,177 @@
+"""Per-user online learner fed by manual quarantine, restore and allow actions.
+
+Each account has its own logistic regression over the hashed subject tokens and sender domains
+of app/model.py (not header presence, which nearly every message shares, nor TLDs and public
+suffixes such as `com` or `co.uk`, which unrelated senders share), updated by one SGD
+step per labelled message that touches only that message's features. Every step is appended
+to the account's journal as (sequence, delta, feature indices); after `compact_after` steps
+the weights are written out as a snapshot and the journal is cleared. Loading reads the
+snapshot and replays journal entries newer than it, so nothing is retrained and the audit
+history is never re-read. Steps hold the account's `<key>.lock` flock from reloading the state
+to appending (and compacting), so workers sharing DATA_DIR never interleave or lose steps.
+In-process, each account's state has its own mutex, taken after the flock: a step waiting on
+another worker blocks nothing, and one account's step never blocks another account's reads.
+
+There is no bias term: a learner that has seen nothing, or a message sharing no features with
+anything it has seen, predicts 0.5, which leaves the score untouched. Undoing many quarantines
+therefore lowers the scores of similar messages, not of everything.
+"""
+import contextlib, fcntl, math, os, struct, tempfile, threading
+from array import array
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional
+
+from .model import features
+
+SNAPSHOT = struct.Struct("<4sIII")  # magic, bits, steps, number of weights
+MAGIC = b"SFL1"
+STEP = struct.Struct("<IfH")  # sequence, delta, number of indices
+
+
+def _sigmoid(z: float) -> float:
+    return 1.0 / (1.0 + math.exp(-max(-30.0, min(30.0, z))))
+
+
+class _State:
+    def __init__(self, bits: int):
+        self.bits = bits
+        self.steps = 0
+        self.weights: Dict[int, float] = {}
+        self.journaled = 0  # steps in the journal since the last snapshot
+        self.stamp = None  # files as last read or written, to notice other workers' steps
+
+    def apply(self, delta: float, idx: Iterable[int]):
+        w = self.weights
+        for j in idx:
+            w[j] = w.get(j, 0.0) + delta
+        self.steps += 1
+
+    def predict(self, idx: Iterable[int]) -> float:
+        w = self.weights
+        return _sigmoid(sum(w.get(j, 0.0) for j in idx))
+
+
+class OnlineLearner:
+    """Learners for every account, stored as `<key>.bin` (snapshot) and `<key>.log` (journal) under `root`."""
+
+    def __init__(self, root: Path, key: Callable[[str], str], bits: int = 20, rate: float = 0.5, compact_after: int = 500):
+        self.root = root
+        self.key = key
+        self.bits = bits
+        self.rate = rate
+        self.compact_after = compact_after
+        self._states: Dict[str, _State] = {}
+        self._mutexes: Dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()  # guards _mutexes
+
+    def _paths(self, email: str):
+        key = self.key(email)
+        return self.root / f"{key}.bin", self.root / f"{key}.log"
+
+    def _mutex(self, email: str) -> threading.Lock:
+        with self._lock:
+            return self._mutexes.setdefault(email, threading.Lock())
+
+    @contextlib.contextmanager
+    def _locked(self, email: str) -> Iterator[None]:
+        with open(self.root / f"{self.key(email)}.lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)  # released when the file is closed
+            yield
+
+    def _stamp(self, email: str):
+        stamp = []
+        for p in self._paths(email):
+            try:
+                st = p.stat()
+                stamp.append((st.st_mtime_ns, st.st_size))
+            except FileNotFoundError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def _load(self, email: str) -> _State:
+        snapshot, journal = self._paths(email)
+        state = _State(self.bits)
+        if snapshot.exists():
+            data = snapshot.read_bytes()
+            magic, bits, steps, n = SNAPSHOT.unpack_from(data)
+            if magic == MAGIC and bits == self.bits:
+                idx, w = array("I"), array("d")
+                idx.frombytes(data[SNAPSHOT.size:SNAPSHOT.size + 4 * n])
+                w.frombytes(data[SNAPSHOT.size + 4 * n:SNAPSHOT.size + 12 * n])
+                state.steps, state.weights = steps, dict(zip(idx, w))
+        if journal.exists():
+            data, pos = journal.read_bytes(), 0
+            while pos + STEP.size <= len(data):
+                seq, delta, n = STEP.unpack_from(data, pos)
+                end = pos + STEP.size + 4 * n
+                if end > len(data):
+                    break  # torn final write
+                if seq > state.steps:  # older ones are already in the snapshot
+                    idx = array("I")
+                    idx.frombytes(data[pos + STEP.size:end])
+                    state.apply(delta, idx)
+                    state.journaled += 1
+                pos = end
+        return state
+
+    def _state(self, email: str) -> _State:
+        stamp = self._stamp(email)
+        state = self._states.get(email)
+        if state is None or state.stamp != stamp:
+            state = self._states[email] = self._load(email)
+            state.stamp = stamp
+        return state
+
+    def _compact(self, email: str, state: _State):
+        snapshot, journal = self._paths(email)
+        idx, w = array("I", state.weights.keys()), array("d", state.weights.values())
+        fd, tmp = tempfile.mkstemp(dir=self.root, prefix=snapshot.name, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            f.write(SNAPSHOT.pack(MAGIC, state.bits, state.steps, len(idx)))
+            f.write(idx.tobytes())
+            f.write(w.tobytes())
+        os.replace(tmp, snapshot)
+        journal.unlink(missing_ok=True)
+        state.journaled = 0
+
+    def steps(self, email: str) -> int:
+        """How many labelled messages the account's learner has seen."""
+        with self._mutex(email):
+            return self._state(email).steps
+
+    def version(self, email: str) -> Optional[str]:
+        """Changes with every step; None while the account's learner is untrained."""
+        steps = self.steps(email)
+        return f"l{steps}" if steps else None
+
+    def predict_batch(self, email: str, headers: Iterable[Dict[str, str]]) -> List[float]:
+        with self._mutex(email):
+            state = self._state(email)
+            return [state.predict(features(h, self.bits, presence=False)) for h in headers]
+
+    def learn(self, email: str, headers: Iterable[Dict[str, str]], label: int):
+        """One step towards `label` (1 spam, 0 not spam) per message, appended to the journal."""
+        self.root.mkdir(parents=True, exist_ok=True)
+        with self._locked(email), self._mutex(email):
+            state = self._state(email)  # reloaded if another worker stepped since
+            records = []
+            for h in headers:
+                idx = features(h, self.bits, presence=False)
+                delta = array("f", [-self.rate * (state.predict(idx) - label)])[0]  # as journaled, so a replay is exact
+                state.apply(delta, idx)
+                state.journaled += 1
+                records.append(STEP.pack(state.steps, delta, len(idx)) + array("I", idx).tobytes())
+            if not records:
+                return
+            with self._paths(email)[1].open("ab") as f:
+                f.write(b"".join(records))
+            if state.journaled >= self.compact_after:
+                self._compact(email, state)
+            state.stamp = self._stamp(email)
+
+    def forget(self, email: str):
+        self.root.mkdir(parents=True, exist_ok=True)
+        with self._locked(email), self._mutex(email):
+            self._states.pop(email, None)
+            for p in self._paths(email):
+                p.unlink(missing_ok=True)
@@ -1,11 +1,12 @@
 
-import os, uuid, time, json, httpx, re
+import os, sys, uuid, time, json, math, asyncio, logging, httpx, calendar, contextlib, datetime
 from pathlib import Path
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple, Callable
 
 from fastapi import FastAPI, Request, Response, HTTPException, Body, Query, Path as FPath, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import RedirectResponse, JSONResponse, HTMLResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import RedirectResponse, JSONResponse, HTMLResponse, StreamingResponse
 from dotenv import load_dotenv
 from itsdangerous import URLSafeSerializer, BadSignature
 from pydantic import BaseModel
@@ -13,6 +14,21 @@ from pydantic import BaseModel
 from google.oauth2.credentials import Credentials
 from googleapiclient.discovery import build
 
+from . import audit as audit_store
+from .cache import TTLCache
+from .events import EventBus, sse
+from .gmail_client import GmailClient, GmailError
+from .jobs import Job, JobQueue
+from .learner import OnlineLearner
+from .model import LABEL_EVENTS, LinearModel, labels_from_audit, train
+from .push import PushDispatcher, decode_push
+from .ratelimit import RateLimiter
+from .rules import RuleSet
+from .scheduler import LeaderLock, Scheduler
+from .scores import ScoreCache
+from .store import FileStore, SQLiteStore, user_key
+from .tokens import TokenManager, with_expiry
+
 load_dotenv()
 
 # ---------- Config ----------
@@ -25,11 +41,45 @@ API_KEY = os.getenv("API_KEY")
 
 TOKEN_STORE = Path(os.getenv("TOKEN_STORE", "./tokens"))
 DATA_DIR = Path(os.getenv("DATA_DIR", "./data"))
+STATE_BACKEND = os.getenv("STATE_BACKEND", "files")  # "files": JSON per account under TOKEN_STORE/DATA_DIR; "sqlite": one database
+STATE_DB = Path(os.getenv("STATE_DB", str(DATA_DIR / "state.sqlite3")))
+STATE_DB_POOL = int(os.getenv("STATE_DB_POOL", "8"))
 RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "30"))
 DEFAULT_QUARANTINE_LABEL = os.getenv("DEFAULT_QUARANTINE_LABEL", "Sift/Quarantine")
-
-for p in [TOKEN_STORE, DATA_DIR / "settings", DATA_DIR / "rules", DATA_DIR / "logs"]:
-    p.mkdir(parents=True, exist_ok=True)
+GMAIL_BATCH_SIZE = max(1, min(int(os.getenv("GMAIL_BATCH_SIZE", "50")), 100))  # Gmail caps batches at 100 calls
+GMAIL_MAX_CONNECTIONS = int(os.getenv("GMAIL_MAX_CONNECTIONS", "100"))
+GMAIL_USER_CONCURRENCY = int(os.getenv("GMAIL_USER_CONCURRENCY", "4"))
+GMAIL_CACHE_TTL = int(os.getenv("GMAIL_CACHE_TTL", "3600"))
+GMAIL_CACHE_SIZE = int(os.getenv("GMAIL_CACHE_SIZE", "1024"))
+GMAIL_USER_QUOTA = float(os.getenv("GMAIL_USER_QUOTA", "250"))  # quota units per second per account, per server process
+GMAIL_PROJECT_QUOTA = float(os.getenv("GMAIL_PROJECT_QUOTA", "20000"))  # quota units per second for all accounts, per server process
+GMAIL_MAX_RETRIES = int(os.getenv("GMAIL_MAX_RETRIES", "5"))
+GMAIL_RETRY_BASE = float(os.getenv("GMAIL_RETRY_BASE", "0.5"))
+GMAIL_RETRY_CAP = float(os.getenv("GMAIL_RETRY_CAP", "32"))
+TOKEN_REFRESH_MARGIN = int(os.getenv("TOKEN_REFRESH_MARGIN", "300"))  # refresh this many seconds before expiry
+TOKEN_REFRESH_INTERVAL = int(os.getenv("TOKEN_REFRESH_INTERVAL", "60"))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "0.5"))
+EVENTS_HEARTBEAT = float(os.getenv("EVENTS_HEARTBEAT", "15"))  # seconds between keep-alive comments on idle event streams
+SCORE_CACHE_DB = Path(os.getenv("SCORE_CACHE_DB", str(DATA_DIR / "scores.sqlite3")))
+SCORE_BATCH_MAX = int(os.getenv("SCORE_BATCH_MAX", "10000"))
+SCORE_MODEL_PATH = Path(os.getenv("SCORE_MODEL_PATH", str(DATA_DIR / "model.bin")))
+SCORE_MODEL_WEIGHT = float(os.getenv("SCORE_MODEL_WEIGHT", "0.4"))  # share of the final score taken by the model
+LEARNER_WEIGHT = float(os.getenv("LEARNER_WEIGHT", "0.5"))  # most a user's own feedback can move a score, either way
+LEARNER_RATE = float(os.getenv("LEARNER_RATE", "0.5"))
+LEARNER_MIN_STEPS = int(os.getenv("LEARNER_MIN_STEPS", "10"))  # labelled messages before feedback affects scores
+LEARNER_CEILING = float(os.getenv("LEARNER_CEILING", "0.65"))  # feedback alone never lifts a score past this (below the 0.7 threshold)
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_USER_CONCURRENCY = int(os.getenv("JOB_USER_CONCURRENCY", "1"))
+SCHEDULER_INTERVAL = float(os.getenv("SCHEDULER_INTERVAL", "0"))  # seconds between sweeps of an account; 0 disables
+SCHEDULER_CONCURRENCY = int(os.getenv("SCHEDULER_CONCURRENCY", "4"))
+SCHEDULER_JITTER = float(os.getenv("SCHEDULER_JITTER", "30"))
+SCHEDULER_MAX_BACKOFF = float(os.getenv("SCHEDULER_MAX_BACKOFF", "3600"))
+SCHEDULER_MAX_RESULTS = int(os.getenv("SCHEDULER_MAX_RESULTS", "100"))
+GMAIL_PUSH_TOPIC = os.getenv("GMAIL_PUSH_TOPIC", "")  # projects/<project>/topics/<topic>; empty: no watches are registered
+GMAIL_PUSH_TOKEN = os.getenv("GMAIL_PUSH_TOKEN", "")  # must match ?token= on the push subscription's endpoint URL
+GMAIL_WATCH_RENEW = float(os.getenv("GMAIL_WATCH_RENEW", "86400"))  # Gmail drops a watch after 7 days
+
+DATA_DIR.mkdir(parents=True, exist_ok=True)
 
 GOOGLE_AUTH_URL = "https://accounts.google.com/o/oauth2/v2/auth"
 GOOGLE_TOKEN_URL = "https://oauth2.googleapis.com/token"
@@ -58,111 +108,267 @@ def verify_api_key(x_api_key: Optional[str] = Header(None)):
     return True
 
 # ---------- Persistence helpers ----------
-def user_key(email:str)->str:
-    return email.replace("/", "_")
+# Tokens, settings, rules, sync checkpoints and audit logs live in a state store (app/store.py):
+# a JSON file per account and kind, or with STATE_BACKEND=sqlite a single WAL-mode database.
+store = SQLiteStore(STATE_DB, pool_size=STATE_DB_POOL) if STATE_BACKEND == "sqlite" else FileStore(TOKEN_STORE, DATA_DIR)
+
+def list_accounts() -> List[str]:
+    return store.accounts()
 
-def token_path(email:str) -> Path:
-    return TOKEN_STORE / f"{user_key(email)}.json"
+def has_tokens(email:str) -> bool:
+    return store.stamp("tokens", email) is not None
 
 def save_tokens(email:str, data:dict):
-    token_path(email).write_text(json.dumps(data, indent=2))
+    store.save("tokens", email, data)
+    invalidate_gmail_cache(email)
 
-def load_tokens(email:str) -> dict:
-    p = token_path(email)
-    if not p.exists():
-        raise FileNotFoundError("No tokens for user")
-    return json.loads(p.read_text())
+def _no_tokens() -> dict:
+    raise FileNotFoundError("No tokens for user")
 
-def settings_path(email:str)->Path:
-    return DATA_DIR / "settings" / f"{user_key(email)}.json"
+def load_tokens(email:str) -> dict:
+    return store.load("tokens", email, _no_tokens)
 
-def load_settings(email:str)->dict:
-    p = settings_path(email)
-    if p.exists():
-        return json.loads(p.read_text())
+def _default_settings() -> dict:
     return {"shadow": True}
 
-def save_settings(email:str, data:dict):
-    settings_path(email).write_text(json.dumps(data, indent=2))
+def load_settings(email:str)->dict:
+    return store.load("settings", email, _default_settings)
 
-def rules_path(email:str)->Path:
-    return DATA_DIR / "rules" / f"{user_key(email)}.json"
+def _default_rules() -> dict:
+    return {"allow": [], "block": []}
 
 def load_rules(email:str)->dict:
-    p = rules_path(email)
-    if p.exists():
-        return json.loads(p.read_text())
-    return {"allow": [], "block": []}
+    return store.load("rules", email, _default_rules)
+
+def _update(kind:str, email:str, fn, default, entry:dict) -> dict:
+    """Read-modify-write of one document that no concurrent update, in any worker, can interleave with.
+
+    Waits for the document's lock (or SQLite's write lock): call it from a thread, not the event loop.
+    """
+    audit_writer.flush(email)  # entries already buffered stay ahead of this one
+    data, written = store.update(kind, email, fn, default, entry)
+    publish_audit(email, written)
+    return data
+
+def update_settings(email:str, fn, entry:dict) -> dict:
+    """Apply `fn` to the user's settings in place, save them and log `entry` (in one transaction on SQLite)."""
+    return _update("settings", email, fn, _default_settings, entry)
 
-def save_rules(email:str, data:dict):
-    rules_path(email).write_text(json.dumps(data, indent=2))
+def update_rules(email:str, fn, entry:dict) -> dict:
+    """Apply `fn` to the user's rules in place, save them and log `entry` (in one transaction on SQLite)."""
+    data = _update("rules", email, fn, _default_rules, entry)
+    _ruleset_cache.pop(email)
+    return data
 
-def audit_path(email:str)->Path:
-    return DATA_DIR / "logs" / f"{user_key(email)}.jsonl"
+def load_sync_state(email:str)->dict:
+    """Last processed Gmail historyId per label: {"INBOX": "123456", ...}"""
+    return store.load("sync", email, dict)
+
+# Live events for GET /events. Audit entries are published as they reach the store, with their
+# id there as event id, so a stream can resume from the store after a disconnect.
+event_bus = EventBus()
+
+def publish_audit(email:str, written:List[Tuple[int, str]]):
+    for end, line in written:
+        event_bus.publish(email, "audit", line, end)
+
+audit_writer = audit_store.AuditWriter(store.append_audit, interval=AUDIT_FLUSH_INTERVAL, on_write=publish_audit)
 
 def audit_append(email:str, entry:dict):
-    with audit_path(email).open("a") as f:
-        f.write(json.dumps(entry) + "\n")
-
-def audit_list(email:str, limit:int=200)->List[dict]:
-    p = audit_path(email)
-    items = []
-    if not p.exists():
-        return items
-    with p.open() as f:
-        for line in f:
-            try:
-                items.append(json.loads(line))
-            except Exception:
-                pass
-    return items[-limit:]
+    audit_writer.append(email, entry)
+
+def audit_list(email:str, limit:int=200, cursor:Optional[int]=None, events:Optional[List[str]]=None,
+               since:Optional[int]=None, until:Optional[int]=None) -> Tuple[List[dict], Optional[int]]:
+    """Newest `limit` matching entries (oldest first) before `cursor`, and the cursor for older ones."""
+    audit_writer.flush(email)
+    return store.audit_page(email, limit=limit, cursor=cursor, events=events, since=since, until=until)
 
 # ---------- Gmail client ----------
-def gmail_service_from_email(email:str):
+# Built credentials (and, for the discovery routes, services) are reused across requests
+# until they expire, fall out of the LRU, or the user's tokens change.
+_credentials_cache: TTLCache[Credentials] = TTLCache(maxsize=GMAIL_CACHE_SIZE, ttl=GMAIL_CACHE_TTL)
+_label_cache: TTLCache[Dict[str, str]] = TTLCache(maxsize=GMAIL_CACHE_SIZE, ttl=GMAIL_CACHE_TTL)  # email -> {label name: id}
+
+def invalidate_gmail_cache(email:str):
+    _credentials_cache.pop(email)
+    _label_cache.pop(email)
+
+def credentials_from_email(email:str) -> Credentials:
+    creds = _credentials_cache.get(email)
+    if creds is not None:
+        return creds
     data = load_tokens(email)
-    creds = Credentials(
+    expiry = datetime.datetime.fromtimestamp(data["expires_at"], datetime.timezone.utc).replace(tzinfo=None) if data.get("expires_at") else None
+    return _credentials_cache.set(email, Credentials(
         token=data.get("access_token"),
         refresh_token=data.get("refresh_token"),
+        expiry=expiry,
         token_uri=GOOGLE_TOKEN_URL,
         client_id=GOOGLE_CLIENT_ID,
         client_secret=GOOGLE_CLIENT_SECRET,
         scopes=SCOPES.split(" ")
-    )
-    return build("gmail", "v1", credentials=creds)
+    ))
+
+# One process sharing DATA_DIR runs the sweeps and background token refreshes; the others stand by to take over.
+scheduler_lock = LeaderLock(DATA_DIR / "scheduler.lock")
+
+token_manager = TokenManager(load_tokens, save_tokens, list_accounts, GOOGLE_CLIENT_ID, GOOGLE_CLIENT_SECRET, GOOGLE_TOKEN_URL,
+                             margin=TOKEN_REFRESH_MARGIN, interval=TOKEN_REFRESH_INTERVAL, leader=scheduler_lock)
+
+async def gmail_access_token(email:str, force_refresh:bool=False) -> str:
+    creds = _credentials_cache.get(email) or await asyncio.to_thread(credentials_from_email, email)  # a miss reads the store
+    expires_at = calendar.timegm(creds.expiry.timetuple()) if creds.expiry else None
+    if force_refresh or not creds.token or token_manager.expiring(expires_at):
+        return await token_manager.refresh(email, force=force_refresh)
+    return creds.token
+
+gmail = GmailClient(gmail_access_token, max_connections=GMAIL_MAX_CONNECTIONS, per_user_concurrency=GMAIL_USER_CONCURRENCY,
+                    limiter=RateLimiter(GMAIL_USER_QUOTA, GMAIL_PROJECT_QUOTA),
+                    max_retries=GMAIL_MAX_RETRIES, retry_base=GMAIL_RETRY_BASE, retry_cap=GMAIL_RETRY_CAP)
+
+def http_error(e: Exception) -> HTTPException:
+    """400 for a failed request, except Gmail throttling (429) and outages (503) that outlasted our retries."""
+    if isinstance(e, GmailError) and e.retryable:
+        headers = {"Retry-After": str(math.ceil(e.retry_after))} if e.retry_after else None
+        return HTTPException(status_code=429 if e.throttled else 503, detail=str(e), headers=headers)
+    return HTTPException(status_code=400, detail=str(e))
+
+@app.exception_handler(GmailError)
+async def gmail_error_handler(request: Request, e: GmailError):
+    """Same mapping for routes that let Gmail errors propagate."""
+    err = http_error(e)
+    return JSONResponse(status_code=err.status_code, content={"detail": err.detail}, headers=err.headers)
+
+@app.on_event("startup")
+async def start_background_tasks():
+    token_manager.start()
+    audit_writer.start()
+    score_cache.prune(time.time() - RETENTION_DAYS * 86400)
+    jobs.start()
+    jobs.prune(time.time() - RETENTION_DAYS * 86400)
+    scheduler.start()
+    watcher.start()
+
+@app.on_event("shutdown")
+async def stop_background_tasks():
+    await watcher.stop()
+    await push.stop()
+    await scheduler.stop()
+    scheduler_lock.release()
+    await jobs.stop()
+    await token_manager.stop()
+    await gmail.aclose()
+    await audit_writer.stop()
+    score_cache.close()
+    store.close()
+
+@app.middleware("http")
+async def flush_audit_after_request(request: Request, call_next):
+    # group-commit: everything a request audited goes out in one write per user
+    response = await call_next(request)
+    if audit_writer.pending:
+        await run_in_threadpool(audit_writer.flush)
+    return response
 
 # ---------- Scoring ----------
-SUS_SUBJECT = re.compile(r"(free|winner|congratulations|urgent|verify|invoice|payment|limited|act now|gift|deal|promo|offer)", re.I)
-SUS_FROM = re.compile(r"(noreply@|no-reply@|mailer-daemon|.*\.(ru|cn|tk|xyz|top|icu)$)", re.I)
-SUS_DOMAINS = re.compile(r"(bit\.ly|linktr\.ee|tinyurl\.com|t\.co|kutt\.it)", re.I)
-
-def sender_parts(headers:Dict[str,str]):
-    fromv = headers.get("From","") or ""
-    m = re.search(r"<([^>]+)>", fromv)
-    addr = (m.group(1) if m else fromv).strip().lower()
-    dom = addr.split("@")[-1] if "@" in addr else ""
-    return addr, dom
-
-def score_email(headers: Dict[str,str], snippet:str="", allow:list=None, block:list=None) -> Dict[str, Any]:
-    allow = allow or []
-    block = block or []
-    score = 0.0
-    reasons = []
-    subj = headers.get("Subject", "") or ""
-    addr, dom = sender_parts(headers)
-    rp = headers.get("Return-Path", "") or ""
-
-    if any(e.lower() in (addr, "@"+dom) for e in [a.lower() for a in allow]):
-        return {"score": 0.0, "reasons": ["allowlist"]}
-    if any(e.lower() in (addr, "@"+dom, dom) for e in [b.lower() for b in block]):
-        score += 0.6; reasons.append("blocklist")
-
-    if SUS_SUBJECT.search(subj): score += 0.3; reasons.append("subject_pattern")
-    if SUS_FROM.search(addr) or SUS_FROM.search(rp): score += 0.25; reasons.append("sender_pattern")
-    if "List-Unsubscribe" not in headers: score += 0.1; reasons.append("no_unsubscribe")
-    if SUS_DOMAINS.search(snippet or ""): score += 0.15; reasons.append("link_shortener")
-    if snippet and len(snippet) < 20: score += 0.05; reasons.append("short_snippet")
-    score = min(score, 1.0)
-    return {"score": round(score,2), "reasons": reasons}
+# Compiled rulesets are keyed by the stored rules' stamp, so edits made by another worker are
+# picked up on the next request.
+_ruleset_cache: TTLCache[Tuple[Any, RuleSet]] = TTLCache(maxsize=GMAIL_CACHE_SIZE, ttl=GMAIL_CACHE_TTL)
+
+def rules_for(email:str) -> RuleSet:
+    """The user's allow/block rules compiled into a RuleSet, rebuilt only when they change."""
+    stamp = store.stamp("rules", email)
+    hit = _ruleset_cache.get(email)
+    if hit is not None and hit[0] == stamp:
+        return hit[1]
+    return _ruleset_cache.set(email, (stamp, RuleSet.from_rules(load_rules(email))))[1]
+
+# Optional learned stage on top of the heuristics (see app/model.py), written by POST /model/train.
+score_model = LinearModel(SCORE_MODEL_PATH)
+
+# Per-account weights learned from the user's own quarantine/undo/allow actions; see app/learner.py.
+learner = OnlineLearner(DATA_DIR / "learner", user_key, rate=LEARNER_RATE)
+
+def learner_version(email:Optional[str]) -> Optional[str]:
+    """The account learner's version once it has seen LEARNER_MIN_STEPS messages, else None (not applied)."""
+    if not email or learner.steps(email) < LEARNER_MIN_STEPS:
+        return None
+    return learner.version(email)
+
+def score_version(rules:RuleSet, email:Optional[str]=None) -> str:
+    """Version scores are cached under: the rules', the deployed model's and the account learner's."""
+    parts = [rules.version, score_model.version, learner_version(email)]
+    return ".".join(v for v in parts if v)
+
+def score_records(rules:RuleSet, records:List[Tuple[Dict[str,str], Optional[str]]], email:Optional[str]=None) -> Tuple[List[float], List[List[str]]]:
+    """Heuristic scores for (headers, snippet) records, blended with the model's spam probability.
+
+    The model takes SCORE_MODEL_WEIGHT of the score and adds a "model" reason when it leans
+    spam. With `email`, the account's learner then moves the score by up to LEARNER_WEIGHT
+    either way ("feedback"): down freely, but up only as far as LEARNER_CEILING, so feedback
+    alone cannot get a message quarantined. Allowlisted senders keep their 0.
+    """
+    scores, reasons = rules.score_batch(records)
+    probs = score_model.predict_batch(records)
+    if probs is not None:
+        for i, prob in enumerate(probs):
+            if reasons[i] != ["allowlist"]:
+                scores[i] = round((1 - SCORE_MODEL_WEIGHT) * scores[i] + SCORE_MODEL_WEIGHT * prob, 2)
+                if prob >= 0.5:
+                    reasons[i].append("model")
+    if learner_version(email):
+        for i, prob in enumerate(learner.predict_batch(email, [headers for headers, _ in records])):
+            shift = LEARNER_WEIGHT * (2 * prob - 1)
+            if shift > 0:
+                shift = min(shift, max(0.0, LEARNER_CEILING - scores[i]))
+            if reasons[i] != ["allowlist"] and abs(shift) >= 0.01:
+                scores[i] = round(min(1.0, max(0.0, scores[i] + shift)), 2)
+                reasons[i].append("feedback")
+    return scores, reasons
+
+# Message metadata and scores, persisted across requests and restarts; see app/scores.py.
+score_cache = ScoreCache(SCORE_CACHE_DB)
+
+log = logging.getLogger("siftmail")
+
+def cache_write(write:Callable[..., None], *args):
+    """Run a score-cache write that only saves work later, logging a failure (e.g. the database is locked) instead of raising.
+
+    The Gmail call or scoring it records has already happened; losing the cached copy must not fail the request.
+    """
+    try:
+        write(*args)
+    except Exception as e:
+        log.warning("score cache %s failed: %s", write.__name__, e)
+
+def scores_for(email:str, metas:List[Dict[str, Any]], rules:RuleSet) -> Dict[str, Dict[str, Any]]:
+    """Scores keyed by message id for fetched metadata, reusing those cached under `score_version(rules)`.
+
+    Reads and writes the score cache and the account's learner, so async callers run it in the threadpool.
+    """
+    ok = [m for m in metas if "error" not in m]
+    version = score_version(rules, email)
+    found = score_cache.scores(email, [m["id"] for m in ok], version)
+    todo = [m for m in ok if m["id"] not in found]
+    scores, reasons = score_records(rules, [(m["headers"], m.get("snippet")) for m in todo], email)
+    fresh = [(m["id"], {"score": sc, "reasons": why}) for m, sc, why in zip(todo, scores, reasons)]
+    cache_write(score_cache.store_scores, email, version, fresh)
+    found.update(fresh)
+    return found
+
+async def learn_from_action(email:str, ids:List[str], label:int):
+    """Teach the account's learner that the user quarantined (1) or restored/allowed (0) these messages.
+
+    Call once the action has gone through. Only messages whose metadata is in the score cache
+    are learned from; the rest are skipped rather than fetched, so an action stays one Gmail call.
+    """
+    def learn():
+        metas = score_cache.metadata(email, ids)
+        learner.learn(email, [m["headers"] for m in metas.values() if m.get("headers")], label)
+    try:
+        await asyncio.to_thread(learn)  # the journal append waits on the account's flock
+    except Exception as e:
+        log.warning("could not learn from %s's action: %s", email, e)  # the action itself went through
 
 # ---------- Models ----------
 class ModeIn(BaseModel):
@@ -178,6 +384,19 @@ class ActionIn(BaseModel):
     message_id: str
     action: str  # 'quarantine' | 'undo' | 'allow'
 
+class BulkActionIn(BaseModel):
+    email: str
+    message_ids: List[str]
+    action: str  # 'quarantine' | 'undo'
+
+class ScoreRecord(BaseModel):
+    headers: Dict[str, str]
+    snippet: Optional[str] = ""
+
+class BatchScoreIn(BaseModel):
+    email: Optional[str] = None  # score with this account's rules; built-in heuristics only when omitted
+    records: List[ScoreRecord]
+
 # ---------- Routes ----------
 @app.get("/health")
 def health():
@@ -234,15 +453,14 @@ async def auth_callback(request: Request, code: Optional[str]=None, state: Optio
     if not email:
         try:
             svc = build("gmail","v1",credentials=Credentials(tokens.get("access_token")))
-            email = svc.users().getProfile(userId="me").execute().get("emailAddress")
+            email = svc.users().getProfile(userId="me").execute(num_retries=GMAIL_MAX_RETRIES).get("emailAddress")
         except Exception:
             email = None
     if not email:
         return JSONResponse(status_code=500, content={"error":"email_lookup_failed"})
 
-    save_tokens(email, tokens)
-    s = load_settings(email); s.setdefault("shadow", True); save_settings(email, s)
-    audit_append(email, {"ts": int(time.time()), "event":"oauth_connected", "email": email})
+    await asyncio.to_thread(save_tokens, email, with_expiry(tokens))
+    await asyncio.to_thread(update_settings, email, lambda s: s.setdefault("shadow", True), {"ts": int(time.time()), "event":"oauth_connected", "email": email})
 
     html = f"<html><body><h2>Connected ✓</h2><p>Account: <strong>{email}</strong></p><p>You can close this tab and return to the app.</p></body></html>"
     resp = HTMLResponse(content=html)
@@ -256,11 +474,8 @@ def get_mode(email: str):
 
 @app.post("/mode", dependencies=[Depends(verify_api_key)])
 def set_mode(body: ModeIn):
-    s = load_settings(body.email)
-    s["shadow"] = bool(body.shadow)
-    save_settings(body.email, s)
-    audit_append(body.email, {"ts": int(time.time()), "event":"mode_set", "shadow": s["shadow"]})
-    return s
+    shadow = bool(body.shadow)
+    return update_settings(body.email, lambda s: s.update(shadow=shadow), {"ts": int(time.time()), "event":"mode_set", "shadow": shadow})
 
 @app.get("/rules", dependencies=[Depends(verify_api_key)])
 def get_rules(email: str):
@@ -268,183 +483,608 @@ def get_rules(email: str):
 
 @app.post("/rules/allow", dependencies=[Depends(verify_api_key)])
 def add_allow(body: RulesIn):
-    r = load_rules(body.email)
-    r["allow"] = sorted(list(set(r.get("allow", []) + body.entries)))
-    save_rules(body.email, r)
-    audit_append(body.email, {"ts": int(time.time()), "event":"rules_allow_add", "entries": body.entries})
-    return r
+    def add(r):
+        r["allow"] = sorted(list(set(r.get("allow", []) + body.entries)))
+    return update_rules(body.email, add, {"ts": int(time.time()), "event":"rules_allow_add", "entries": body.entries})
 
 @app.post("/rules/block", dependencies=[Depends(verify_api_key)])
 def add_block(body: RulesIn):
-    r = load_rules(body.email)
-    r["block"] = sorted(list(set(r.get("block", []) + body.entries)))
-    save_rules(body.email, r)
-    audit_append(body.email, {"ts": int(time.time()), "event":"rules_block_add", "entries": body.entries})
-    return r
-
-def get_message_headers(svc, msg_id: str) -> Dict[str, Any]:
-    full = svc.users().messages().get(userId="me", id=msg_id, format="metadata", metadataHeaders=[
-        "From","Subject","Return-Path","Received","List-Unsubscribe","Delivered-To","To","Date","Message-ID"
-    ]).execute()
+    def add(r):
+        r["block"] = sorted(list(set(r.get("block", []) + body.entries)))
+    return update_rules(body.email, add, {"ts": int(time.time()), "event":"rules_block_add", "entries": body.entries})
+
+METADATA_HEADERS = ["From","Subject","Return-Path","Received","List-Unsubscribe","Delivered-To","To","Date","Message-ID"]
+
+def _parse_metadata(msg_id: str, full: dict) -> Dict[str, Any]:
     headers = {h["name"]: h["value"] for h in full.get("payload", {}).get("headers", [])}
     return {"id": msg_id, "snippet": full.get("snippet"), "internalDate": full.get("internalDate"), "headers": headers}
 
-def ensure_label(svc, name: str) -> str:
-    lbls = svc.users().labels().list(userId="me").execute().get("labels", [])
-    for l in lbls:
-        if l.get("name") == name:
-            return l.get("id")
-    created = svc.users().labels().create(userId="me", body={"name": name, "labelListVisibility":"labelShow","messageListVisibility":"show"}).execute()
-    return created.get("id")
+async def get_message_headers(email: str, msg_id: str) -> Dict[str, Any]:
+    meta = (await run_in_threadpool(score_cache.metadata, email, [msg_id])).get(msg_id)
+    if meta is None:
+        meta = _parse_metadata(msg_id, await gmail.get_metadata(email, msg_id, METADATA_HEADERS))
+        await run_in_threadpool(cache_write, score_cache.store_metadata, email, [meta])
+    return meta
+
+async def get_message_headers_batch(email: str, msg_ids: List[str]) -> List[Dict[str, Any]]:
+    """Fetch metadata for many messages through Gmail's batch endpoint, one HTTP exchange per chunk.
+
+    Results keep the order of `msg_ids`. A message that fails carries an "error" key instead of
+    headers, so one bad id does not sink the rest of the batch. Metadata already in the score
+    cache is not fetched again.
+    """
+    metas = await run_in_threadpool(score_cache.metadata, email, msg_ids)
+    missing = [mid for mid in dict.fromkeys(msg_ids) if mid not in metas]
+    if missing:
+        found = await gmail.get_metadata_batch(email, missing, METADATA_HEADERS, chunk_size=GMAIL_BATCH_SIZE)
+        fetched = {mid: {"id": mid, "error": str(r)} if isinstance(r, GmailError) else _parse_metadata(mid, r) for mid, r in zip(missing, found)}
+        await run_in_threadpool(cache_write, score_cache.store_metadata, email, [m for m in fetched.values() if "error" not in m])
+        metas.update(fetched)
+    return [metas[mid] for mid in msg_ids]
+
+def checkpoint_key(consumer: str, label: Optional[str]) -> str:
+    """Sync-state key of one reader's history checkpoint: "sweep:INBOX", "recent:INBOX", ...
+
+    Every incremental reader keeps its own, so one that only looks at new mail (the dashboard's
+    recent list, a dry run) never consumes history the sweep still has to act on.
+    """
+    return f"{consumer}:{label or 'ALL'}"
+
+def load_checkpoint(email: str, consumer: str, label: Optional[str]) -> Optional[str]:
+    state = load_sync_state(email)
+    start = state.get(checkpoint_key(consumer, label))
+    if start is None and consumer == "sweep":
+        start = state.get(label or "ALL")  # saved before checkpoints had a consumer
+    return start
+
+async def list_message_ids(email: str, label: Optional[str], max_results: int, incremental: bool = False,
+                           consumer: str = "sweep") -> Tuple[List[str], Optional[str], str]:
+    """Message ids to process, the historyId to checkpoint once they are handled, and the mode used.
+
+    With `incremental`, only messages added since `consumer`'s checkpoint are returned. Without a
+    checkpoint, or when Gmail has expired it, this falls back to listing the newest `max_results`.
+    """
+    start = load_checkpoint(email, consumer, label) if incremental else None
+    if start:
+        try:
+            ids, history_id = await gmail.added_message_ids(email, start, label=label)
+            return ids, history_id, "incremental"
+        except GmailError as e:
+            if e.status != 404:
+                raise
+    # read the profile first so mail arriving during the listing is replayed next time
+    history_id = (await gmail.get_profile(email)).get("historyId") if incremental else None
+    res = await gmail.list_messages(email, label_ids=[label] if label else None, max_results=max_results)
+    return [m["id"] for m in res.get("messages", [])], history_id, "full"
+
+async def commit_checkpoint(email: str, consumer: str, label: Optional[str], history_id: Optional[str]):
+    """Record that `consumer` has handled `label`'s mail up to `history_id`; it never moves backwards."""
+    if history_id:
+        key = checkpoint_key(consumer, label)
+        def advance(state: dict):
+            state[key] = str(max(int(state.get(key) or 0), int(history_id)))
+        # under the document's lock (sweeps of other labels may be committing theirs), which can wait: off the loop
+        await asyncio.to_thread(store.update, "sync", email, advance, dict)
+
+async def find_label(email: str, name: str) -> Optional[str]:
+    """Resolve a label name to its id from the per-user cache, listing labels only on a miss."""
+    labels = _label_cache.get(email)
+    if labels is None or name not in labels:
+        labels = _label_cache.set(email, {l.get("name"): l.get("id") for l in await gmail.list_labels(email)})
+    return labels.get(name)
+
+async def ensure_label(email: str, name: str) -> str:
+    qid = await find_label(email, name)
+    if qid:
+        return qid
+    qid = (await gmail.create_label(email, name)).get("id")
+    _label_cache.set(email, {**(_label_cache.get(email) or {}), name: qid})
+    return qid
+
+async def move_messages(email: str, msg_ids: List[str], label_name: str, restore: bool = False):
+    """Quarantine messages under `label_name` (or restore them to INBOX).
+
+    One message costs a single modify call; more go through batchModify, 1000 ids per call.
+    A cached label id that Gmail rejects (label deleted or renamed) is dropped and resolved once more.
+    """
+    if not msg_ids:
+        return
+    for attempt in (0, 1):
+        qid = await (find_label(email, label_name) if restore else ensure_label(email, label_name))
+        add, remove = (["INBOX"], [qid] if qid else []) if restore else ([qid], ["INBOX"])
+        try:
+            if len(msg_ids) == 1:
+                res = await gmail.modify(email, msg_ids[0], add=add, remove=remove)
+            else:
+                res = await gmail.batch_modify(email, msg_ids, add=add, remove=remove)
+        except GmailError as e:
+            if attempt or e.status not in (400, 404) or not qid:
+                raise
+            _label_cache.pop(email)
+            continue
+        await run_in_threadpool(cache_write, score_cache.mark_quarantined, email, msg_ids, not restore)  # the move went through
+        return res
 
 @app.get("/gmail/messages", dependencies=[Depends(verify_api_key)])
-def gmail_messages(email: str, label: str = "INBOX", max_results: int = 25, q: Optional[str]=None):
+async def gmail_messages(email: str, label: str = "INBOX", max_results: int = 25, q: Optional[str]=None):
     try:
-        svc = gmail_service_from_email(email)
-        res = svc.users().messages().list(userId="me", labelIds=[label] if label else None, q=q, maxResults=max_results).execute()
-        out = [get_message_headers(svc, m["id"]) for m in res.get("messages", [])]
+        res = await gmail.list_messages(email, label_ids=[label] if label else None, q=q, max_results=max_results)
+        out = await get_message_headers_batch(email, [m["id"] for m in res.get("messages", [])])
         return {"messages": out}
     except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+        raise http_error(e)
 
 @app.get("/gmail/messages/{message_id}", dependencies=[Depends(verify_api_key)])
-def gmail_message(email: str, message_id: str = FPath(...)):
+async def gmail_message(email: str, message_id: str = FPath(...)):
     try:
-        svc = gmail_service_from_email(email)
-        return get_message_headers(svc, message_id)
+        return await get_message_headers(email, message_id)
     except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+        raise http_error(e)
 
 @app.post("/gmail/quarantine", dependencies=[Depends(verify_api_key)])
-def gmail_quarantine(email: str = Body(..., embed=True), message_id: str = Body(..., embed=True), label_name: str = Body(DEFAULT_QUARANTINE_LABEL, embed=True)):
+async def gmail_quarantine(email: str = Body(..., embed=True), message_id: str = Body(..., embed=True), label_name: str = Body(DEFAULT_QUARANTINE_LABEL, embed=True)):
     try:
-        svc = gmail_service_from_email(email)
         s = load_settings(email)
         action = "would_quarantine" if s.get("shadow", True) else "quarantine"
         if not s.get("shadow", True):
-            qid = ensure_label(svc, label_name)
-            svc.users().messages().modify(userId="me", id=message_id, body={"addLabelIds":[qid], "removeLabelIds":["INBOX"]}).execute()
+            await move_messages(email, [message_id], label_name)
         audit_append(email, {"ts": int(time.time()), "event": action, "id": message_id})
+        await learn_from_action(email, [message_id], 1)
         return {"ok": True, "action": action}
     except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+        raise http_error(e)
 
 @app.post("/gmail/undo", dependencies=[Depends(verify_api_key)])
-def gmail_undo(email: str = Body(..., embed=True), message_id: str = Body(..., embed=True), label_name: str = Body(DEFAULT_QUARANTINE_LABEL, embed=True)):
+async def gmail_undo(email: str = Body(..., embed=True), message_id: str = Body(..., embed=True), label_name: str = Body(DEFAULT_QUARANTINE_LABEL, embed=True)):
     try:
-        svc = gmail_service_from_email(email)
         s = load_settings(email)
         action = "would_restore" if s.get("shadow", True) else "restore"
         if not s.get("shadow", True):
-            qid = None
-            for l in svc.users().labels().list(userId="me").execute().get("labels", []):
-                if l.get("name") == label_name:
-                    qid = l.get("id"); break
-            svc.users().messages().modify(userId="me", id=message_id, body={"addLabelIds":["INBOX"], "removeLabelIds":[qid] if qid else []}).execute()
+            await move_messages(email, [message_id], label_name, restore=True)
         audit_append(email, {"ts": int(time.time()), "event": action, "id": message_id})
+        await learn_from_action(email, [message_id], 0)
         return {"ok": True, "action": action}
     except Exception as e:
-        raise HTTPException(status_code=400, detail:str(e))
+        raise http_error(e)
+
+async def classify_metadata(email: str, metas: List[Dict[str, Any]], rules: RuleSet, threshold: float, apply_actions: bool, quarantine_label: str) -> List[Dict[str, Any]]:
+    """Score fetched messages, quarantine those at or over `threshold` when `apply_actions`, and audit them."""
+    results, flagged = [], []
+    scores = await run_in_threadpool(scores_for, email, metas, rules)
+    for meta in metas:
+        if "error" in meta:
+            results.append({"id": meta["id"], "action": "error", "error": meta["error"]})
+            continue
+        sc = scores[meta["id"]]
+        item = {"id": meta["id"], "score": sc["score"], "reasons": sc["reasons"], "action": "none"}
+        if sc["score"] >= threshold:
+            item["action"] = "quarantine" if apply_actions else "would_quarantine"
+            flagged.append(item)
+        results.append(item)
+
+    if apply_actions:
+        await move_messages(email, [it["id"] for it in flagged], quarantine_label)
+    for it in flagged:
+        audit_append(email, {"ts": int(time.time()), "event": it["action"], "id": it["id"], "score": it["score"]})
+    if results and event_bus.subscribers(email):  # an empty page (nothing new) would blank the dashboard's table
+        event_bus.publish(email, "classified", json.dumps({"items": results}))
+    return results
+
+def new_progress() -> Dict[str, int]:
+    return {"pages": 0, "scanned": 0, "flagged": 0, "errors": 0}
+
+def add_progress(progress: Dict[str, int], results: List[Dict[str, Any]]):
+    progress["pages"] += 1
+    progress["scanned"] += len(results)
+    progress["flagged"] += sum(it["action"] in ("quarantine", "would_quarantine") for it in results)
+    progress["errors"] += sum(it["action"] == "error" for it in results)
+
+async def classify_pages(email: str, label: Optional[str], page_size: int, rules: RuleSet, threshold: float, apply_actions: bool,
+                         quarantine_label: str, page_token: Optional[str] = None):
+    """Yield (results, next_page_token) for each page of `label`, starting at `page_token`.
+
+    The next page is listed and its metadata fetched while the current one is classified, so at
+    most two pages are held in memory however large the label is.
+    """
+    page_size = max(1, min(page_size, 500))
+
+    async def fetch_page(token: Optional[str]) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        res = await gmail.list_messages(email, label_ids=[label] if label else None, max_results=page_size, page_token=token)
+        return await get_message_headers_batch(email, [m["id"] for m in res.get("messages", [])]), res.get("nextPageToken")
+
+    fetch = asyncio.create_task(fetch_page(page_token))
+    try:
+        while fetch is not None:
+            metas, next_token = await fetch
+            fetch = asyncio.create_task(fetch_page(next_token)) if next_token else None
+            yield await classify_metadata(email, metas, rules, threshold, apply_actions, quarantine_label), next_token
+    finally:
+        if fetch is not None:
+            fetch.cancel()
+
+async def batch_classify(email: str, label: Optional[str] = "INBOX", max_results: int = 50, quarantine_threshold: float = 0.7, dry_run: bool = True,
+                         quarantine_label: str = DEFAULT_QUARANTINE_LABEL, incremental: bool = False) -> Dict[str, Any]:
+    """One page of batch classification; actions are applied only when not `dry_run` and the account is out of shadow mode."""
+    rules = rules_for(email)
+    s = load_settings(email)
+    ids, history_id, mode = await list_message_ids(email, label, max_results, incremental)
+
+    apply_actions = (not dry_run) and (not s.get("shadow", True))
+
+    results = await classify_metadata(email, await get_message_headers_batch(email, ids), rules, quarantine_threshold, apply_actions, quarantine_label)
+    if not dry_run:  # a dry run previews what the next sweep will see; it must not consume it
+        await commit_checkpoint(email, "sweep", label, history_id)
+
+    return {"email": email, "label": label, "threshold": quarantine_threshold, "dry_run": dry_run or s.get("shadow", True), "mode": mode, "count": len(results), "items": results}
 
 @app.post("/gmail/batch-classify", dependencies=[Depends(verify_api_key)])
-def gmail_batch_classify(email: str = Body(..., embed=True), label: str = Body("INBOX", embed=True), max_results: int = Body(50, embed=True), quarantine_threshold: float = Body(0.7, embed=True), dry_run: bool = Body(True, embed=True), quarantine_label: str = Body(DEFAULT_QUARANTINE_LABEL, embed=True)):
+async def gmail_batch_classify(email: str = Body(..., embed=True), label: str = Body("INBOX", embed=True), max_results: int = Body(50, embed=True), quarantine_threshold: float = Body(0.7, embed=True), dry_run: bool = Body(True, embed=True), quarantine_label: str = Body(DEFAULT_QUARANTINE_LABEL, embed=True), incremental: bool = Body(False, embed=True)):
     try:
-        svc = gmail_service_from_email(email)
-        rules = load_rules(email)
-        s = load_settings(email)
-        res = svc.users().messages().list(userId="me", labelIds=[label] if label else None, maxResults=max_results).execute()
-
-        apply_actions = (not dry_run) and (not s.get("shadow", True))
-        qid = ensure_label(svc, quarantine_label) if apply_actions else None
-
-        results = []
-        for m in res.get("messages", []):
-            meta = get_message_headers(svc, m["id"])
-            sc = score_email(meta["headers"], meta.get("snippet",""), rules.get("allow"), rules.get("block"))
-            action = "none"
-            if sc["score"] >= quarantine_threshold:
-                action = "would_quarantine"
-                if apply_actions:
-                    svc.users().messages().modify(userId="me", id=m["id"], body={"addLabelIds":[qid], "removeLabelIds":["INBOX"]}).execute()
-                    action = "quarantine"
-            results.append({"id": m["id"], "score": sc["score"], "reasons": sc["reasons"], "action": action})
-            if action in ("quarantine","would_quarantine"):
-                audit_append(email, {"ts": int(time.time()), "event": action, "id": m["id"], "score": sc["score"]})
-
-        return {"email": email, "label": label, "threshold": quarantine_threshold, "dry_run": dry_run or s.get("shadow", True), "count": len(results), "items": results}
+        return await batch_classify(email, label, max_results, quarantine_threshold, dry_run, quarantine_label, incremental)
     except Exception as e:
-        raise HTTPException(status_code=400, detail=str(e))
+        raise http_error(e)
+
+@app.post("/gmail/batch-classify/stream", dependencies=[Depends(verify_api_key)])
+async def gmail_batch_classify_stream(
+    email: str = Body(..., embed=True),
+    label: str = Body("INBOX", embed=True),
+    page_size: int = Body(100, embed=True),
+    quarantine_threshold: float = Body(0.7, embed=True),
+    dry_run: bool = Body(True, embed=True),
+    quarantine_label: str = Body(DEFAULT_QUARANTINE_LABEL, embed=True)
+):
+    """Classify every message in `label`, following nextPageToken, as an NDJSON stream.
+
+    Each line is one of {"type": "item", ...}, a {"type": "progress", ...} frame after every
+    page, then {"type": "done", ...} or {"type": "error", "detail": ...}. Pages are pipelined by
+    classify_pages, so whole-mailbox runs stay in bounded memory. Finishing a run that is not a
+    dry run records the label's sweep checkpoint for later incremental runs.
+    """
+    settings = load_settings(email)
+    rules = rules_for(email)
+    apply_actions = (not dry_run) and (not settings.get("shadow", True))
+
+    async def frames():
+        progress = new_progress()
+        try:
+            history_id = (await gmail.get_profile(email)).get("historyId")
+            pages = classify_pages(email, label, page_size, rules, quarantine_threshold, apply_actions, quarantine_label)
+            async with contextlib.aclosing(pages):
+                async for results, _ in pages:
+                    add_progress(progress, results)
+                    for it in results:
+                        yield json.dumps({"type": "item", **it}) + "\n"
+                    yield json.dumps({"type": "progress", **progress}) + "\n"
+            if not dry_run:
+                await commit_checkpoint(email, "sweep", label, history_id)
+            yield json.dumps({"type": "done", "email": email, "label": label, "threshold": quarantine_threshold, "dry_run": not apply_actions, **progress}) + "\n"
+        except Exception as e:
+            yield json.dumps({"type": "error", "detail": str(e), "scanned": progress["scanned"]}) + "\n"
+
+    return StreamingResponse(frames(), media_type="application/x-ndjson")
+
+@app.post("/score/batch", dependencies=[Depends(verify_api_key)])
+def score_batch(body: BatchScoreIn):
+    """Score many header/snippet records at once (e.g. re-scoring archived mail); same scores as classification gives them."""
+    if len(body.records) > SCORE_BATCH_MAX:
+        raise HTTPException(status_code=413, detail=f"At most {SCORE_BATCH_MAX} records per call")
+    rules = rules_for(body.email) if body.email else RuleSet()
+    scores, reasons = score_records(rules, [(r.headers, r.snippet) for r in body.records], body.email)
+    return {"version": score_version(rules, body.email), "count": len(scores), "scores": scores, "reasons": reasons}
+
+def train_model() -> Dict[str, Any]:
+    """Fit the model on every account's manual quarantine/restore actions, with features from cached metadata."""
+    examples = []
+    for email in list_accounts():
+        entries, _ = audit_list(email, limit=sys.maxsize, events=list(LABEL_EVENTS))
+        labels = labels_from_audit(entries)
+        metas = score_cache.metadata(email, list(labels))
+        examples += [(meta["headers"], labels[mid]) for mid, meta in metas.items()]
+    return train(examples, SCORE_MODEL_PATH)
+
+@app.post("/model/train", dependencies=[Depends(verify_api_key)])
+async def model_train():
+    """Retrain the scoring model; messages whose metadata is no longer cached are skipped."""
+    return await asyncio.to_thread(train_model)
+
+@app.get("/gmail/metrics", dependencies=[Depends(verify_api_key)])
+async def gmail_metrics():
+    """Gmail call counters since startup: requests, retries, throttled responses, limiter waits."""
+    return gmail.metrics
 
 @app.get("/digest", dependencies=[Depends(verify_api_key)])
-def digest(email: str, label: str = DEFAULT_QUARANTINE_LABEL, limit:int=50, html: bool=False):
+async def digest(email: str, label: str = DEFAULT_QUARANTINE_LABEL, limit:int=50, html: bool=False):
     try:
-        svc = gmail_service_from_email(email)
-        res = svc.users().messages().list(userId="me", labelIds=[label], maxResults=limit).execute()
-        items = []
-        for m in res.get("messages", []):
-            meta = get_message_headers(svc, m["id"])
-            items.append({"id": m["id"], "from": meta["headers"].get("From"), "subject": meta["headers"].get("Subject"), "snippet": meta.get("snippet",""), "date": meta["headers"].get("Date")})
+        res = await gmail.list_messages(email, label_ids=[label], max_results=limit)
+        items, errors = [], []
+        for meta in await get_message_headers_batch(email, [m["id"] for m in res.get("messages", [])]):
+            if "error" in meta:
+                errors.append(meta)
+                continue
+            items.append({"id": meta["id"], "from": meta["headers"].get("From"), "subject": meta["headers"].get("Subject"), "snippet": meta.get("snippet",""), "date": meta["headers"].get("Date")})
         if html:
             rows = "".join([f"<tr><td>{i['from']}</td><td>{i['subject']}</td><td>{i['snippet']}</td><td>{i['date']}</td></tr>" for i in items])
             page = f"<html><body><h2>Sift Mail Digest</h2><table border='1' cellpadding='6'><tr><th>From</th><th>Subject</th><th>Snippet</th><th>Date</th></tr>{rows}</table></body></html>"
             return HTMLResponse(content=page)
-        return {"items": items}
+        return {"items": items, "errors": errors}
     except Exception as e:
-        raise HTTPException(status_code=400, detail:str(e))
+        raise http_error(e)
 
 @app.get("/audit", dependencies=[Depends(verify_api_key)])
-def audit(email: str, limit:int=200):
-    return {"items": audit_list(email, limit=limit)}
+def audit(email: str, limit:int=200, cursor: Optional[int]=None, event: Optional[List[str]] = Query(None),
+          since: Optional[int]=None, until: Optional[int]=None):
+    items, next_cursor = audit_list(email, limit=limit, cursor=cursor, events=event, since=since, until=until)
+    return {"items": items, "next_cursor": next_cursor}
+
+@app.get("/events", dependencies=[Depends(verify_api_key)])
+async def events(email: str, last_event_id: Optional[int] = None, last_event_header: Optional[str] = Header(None, alias="Last-Event-ID")):
+    """Server-sent events for one account: `audit` entries as they are logged and `classified` result pages.
+
+    Audit events carry ids; reconnecting with Last-Event-ID (header or query) first replays the
+    entries logged since then. Classification results are live only.
+    """
+    if last_event_header and last_event_header.isdigit():
+        last_event_id = int(last_event_header)
+
+    async def stream():
+        with event_bus.subscribe(email) as sub:  # before the replay, so nothing logged meanwhile is missed
+            last = -1
+            if last_event_id is not None:
+                await asyncio.to_thread(audit_writer.flush, email)
+                for end, line in await asyncio.to_thread(store.audit_after, email, last_event_id):
+                    yield sse("audit", line, end)
+                    last = end
+            while True:
+                try:
+                    item = await asyncio.wait_for(sub.queue.get(), EVENTS_HEARTBEAT)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if item is None:
+                    return  # fell too far behind; the client reconnects and replays from its last id
+                event_id, name, data = item
+                if event_id is not None:
+                    if event_id <= last:
+                        continue  # already sent by the replay
+                    last = event_id
+                yield sse(name, data, event_id)
+
+    return StreamingResponse(stream(), media_type="text/event-stream", headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 # ---- New: Messages convenience endpoints ----
 @app.get("/messages/recent", dependencies=[Depends(verify_api_key)])
-def messages_recent(email: str, label: str = "INBOX", max_results: int = 50):
-    """Return recent messages with computed score and recommended action (no mutations)."""
-    svc = gmail_service_from_email(email)
-    rules = load_rules(email)
-    res = svc.users().messages().list(userId="me", labelIds=[label] if label else None, maxResults=max_results).execute()
-    out = []
-    for m in res.get("messages", []):
-        meta = get_message_headers(svc, m["id"])
-        sc = score_email(meta["headers"], meta.get("snippet",""), rules.get("allow"), rules.get("block"))
-        out.append({"id": m["id"], "from": meta["headers"].get("From"), "subject": meta["headers"].get("Subject"), "date": meta["headers"].get("Date"), "score": sc["score"], "reasons": sc["reasons"]})
-    return {"items": out}
+async def messages_recent(email: str, label: str = "INBOX", max_results: int = 50, incremental: bool = False):
+    """Return recent messages with computed score and recommended action (no mutations).
+
+    With `incremental`, only messages that arrived since the previous incremental call are returned.
+    That checkpoint is this endpoint's own: it does not move the scheduled sweep's.
+    """
+    rules = rules_for(email)
+    ids, history_id, mode = await list_message_ids(email, label, max_results, incremental, consumer="recent")
+    out, errors = [], []
+    metas = await get_message_headers_batch(email, ids)
+    scores = await run_in_threadpool(scores_for, email, metas, rules)
+    for meta in metas:
+        if "error" in meta:
+            errors.append(meta)
+            continue
+        sc = scores[meta["id"]]
+        out.append({"id": meta["id"], "from": meta["headers"].get("From"), "subject": meta["headers"].get("Subject"), "date": meta["headers"].get("Date"), "score": sc["score"], "reasons": sc["reasons"]})
+    await commit_checkpoint(email, "recent", label, history_id)
+    return {"items": out, "errors": errors, "mode": mode}
+
+@app.get("/messages/search", dependencies=[Depends(verify_api_key)])
+def messages_search(email: str, q: Optional[str] = None, domain: Optional[str] = None, since: Optional[int] = None, until: Optional[int] = None,
+                    min_score: Optional[float] = None, quarantined: Optional[bool] = None, limit: int = 50, offset: int = 0):
+    """Search messages already fetched from Gmail, from the local index only (see app/scores.py).
+
+    `q` matches words of the subject, From header and snippet (`word*` for prefixes); `since`/`until`
+    bound the message date (epoch seconds, both inclusive as in /audit). `freshness` tells how much
+    mail the index holds and when it was last added to: messages never fetched here are not found.
+    """
+    start = time.perf_counter()
+    items = score_cache.search(email, text=q, domain=domain, since=since, until=until, min_score=min_score,
+                               quarantined=quarantined, limit=max(1, min(limit, 500)), offset=max(0, offset))
+    took = round((time.perf_counter() - start) * 1000, 2)
+    return {"items": items, "took_ms": took, "freshness": score_cache.freshness(email)}
+
+@app.get("/messages/top-senders", dependencies=[Depends(verify_api_key)])
+def messages_top_senders(email: str, limit: int = 20):
+    """Sender domains ranked by how many of their messages were quarantined, from the local index."""
+    return {"items": score_cache.top_senders(email, max(1, min(limit, 500))), "freshness": score_cache.freshness(email)}
 
 @app.post("/messages/action", dependencies=[Depends(verify_api_key)])
-def messages_action(body: ActionIn):
+async def messages_action(body: ActionIn):
     """Perform quarantine / undo / allow (allow adds to allowlist). Respects Shadow Mode for mutations."""
     email = body.email
-    svc = gmail_service_from_email(email)
     s = load_settings(email)
 
     if body.action == "allow":
-        r = load_rules(email)
-        r["allow"] = sorted(list(set(r.get("allow", []) + [body.message_id if "@" in body.message_id else body.message_id])))
-        save_rules(email, r)
-        audit_append(email, {"ts": int(time.time()), "event": "allow_added", "val": body.message_id})
+        def add(r):
+            r["allow"] = sorted(list(set(r.get("allow", []) + [body.message_id if "@" in body.message_id else body.message_id])))
+        await asyncio.to_thread(update_rules, email, add, {"ts": int(time.time()), "event": "allow_added", "val": body.message_id})
+        if "@" not in body.message_id:  # a message rather than an address or domain
+            await learn_from_action(email, [body.message_id], 0)
         return {"ok": True, "action": "allow_added"}
 
     if body.action == "quarantine":
         if s.get("shadow", True):
             audit_append(email, {"ts": int(time.time()), "event": "would_quarantine", "id": body.message_id})
+            await learn_from_action(email, [body.message_id], 1)
             return {"ok": True, "action": "would_quarantine"}
-        qid = ensure_label(svc, DEFAULT_QUARANTINE_LABEL)
-        svc.users().messages().modify(userId="me", id=body.message_id, body={"addLabelIds":[qid], "removeLabelIds":["INBOX"]}).execute()
+        await move_messages(email, [body.message_id], DEFAULT_QUARANTINE_LABEL)
         audit_append(email, {"ts": int(time.time()), "event": "quarantine", "id": body.message_id})
+        await learn_from_action(email, [body.message_id], 1)
         return {"ok": True, "action": "quarantine"}
 
     if body.action == "undo":
         if s.get("shadow", True):
             audit_append(email, {"ts": int(time.time()), "event": "would_restore", "id": body.message_id})
+            await learn_from_action(email, [body.message_id], 0)
             return {"ok": True, "action": "would_restore"}
         # remove quarantine, add INBOX
-        qid = None
-        lbls = svc.users().labels().list(userId="me").execute().get("labels", [])
-        for l in lbls:
-            if l.get("name") == DEFAULT_QUARANTINE_LABEL:
-                qid = l.get("id"); break
-        svc.users().messages().modify(userId="me", id=body.message_id, body={"addLabelIds":["INBOX"], "removeLabelIds":[qid] if qid else []}).execute()
+        await move_messages(email, [body.message_id], DEFAULT_QUARANTINE_LABEL, restore=True)
         audit_append(email, {"ts": int(time.time()), "event": "restore", "id": body.message_id})
+        await learn_from_action(email, [body.message_id], 0)
         return {"ok": True, "action": "restore"}
 
     raise HTTPException(status_code=400, detail="Unknown action")
+
+@app.post("/messages/actions/bulk", dependencies=[Depends(verify_api_key)])
+async def messages_actions_bulk(body: BulkActionIn):
+    """Quarantine / undo many messages with batchModify. Respects Shadow Mode; audits each message."""
+    if body.action not in ("quarantine", "undo"):
+        raise HTTPException(status_code=400, detail="Unknown action")
+    email = body.email
+    s = load_settings(email)
+    ids = list(dict.fromkeys(body.message_ids))
+    restore = body.action == "undo"
+    action = "restore" if restore else "quarantine"
+    if s.get("shadow", True):
+        action = "would_" + action
+    else:
+        try:
+            await move_messages(email, ids, DEFAULT_QUARANTINE_LABEL, restore=restore)
+        except Exception as e:
+            raise http_error(e)
+    ts = int(time.time())
+    for mid in ids:
+        audit_append(email, {"ts": ts, "event": action, "id": mid})
+    await learn_from_action(email, ids, 0 if restore else 1)
+    return {"ok": True, "action": action, "count": len(ids)}
+
+# ---------- Jobs ----------
+jobs = JobQueue(DATA_DIR / "jobs", workers=JOB_WORKERS, per_user=JOB_USER_CONCURRENCY)
+
+async def run_classify_job(job: Job) -> Dict[str, Any]:
+    """Whole-label batch-classify as a job; each page's results and resume position are saved as it completes."""
+    p, email = job.params, job.email
+    settings = load_settings(email)
+    apply_actions = (not p["dry_run"]) and (not settings.get("shadow", True))
+    if not job.state.get("history_id"):
+        job.update(history_id=(await gmail.get_profile(email)).get("historyId"), progress=new_progress())
+    if job.state.get("page_token") is None and job.state["progress"]["pages"]:
+        pages = None  # finished every page before a restart
+    else:
+        pages = classify_pages(email, p["label"], p["page_size"], rules_for(email), p["quarantine_threshold"], apply_actions,
+                               p["quarantine_label"], page_token=job.state.get("page_token"))
+    if pages is not None:
+        async with contextlib.aclosing(pages):
+            async for results, next_token in pages:
+                progress = job.state["progress"]
+                add_progress(progress, results)
+                job.update(results, progress=progress, page_token=next_token)
+                if job.cancelled:
+                    return {"dry_run": not apply_actions, **progress}
+    if not p["dry_run"]:
+        await commit_checkpoint(email, "sweep", p["label"], job.state["history_id"])
+    return {"dry_run": not apply_actions, **job.state["progress"]}
+
+jobs.register("batch-classify", run_classify_job)
+
+def job_view(state: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: state.get(k) for k in ("id", "email", "kind", "params", "status", "progress", "result_count", "summary", "error", "created", "started", "finished", "updated")}
+
+@app.post("/jobs/batch-classify", status_code=202, dependencies=[Depends(verify_api_key)])
+async def create_classify_job(
+    email: str = Body(..., embed=True),
+    label: str = Body("INBOX", embed=True),
+    page_size: int = Body(100, embed=True),
+    quarantine_threshold: float = Body(0.7, embed=True),
+    dry_run: bool = Body(True, embed=True),
+    quarantine_label: str = Body(DEFAULT_QUARANTINE_LABEL, embed=True)
+):
+    """Queue a whole-label batch-classify and return at once; poll GET /jobs/{id} for progress and results."""
+    state = jobs.submit(email, "batch-classify", {"label": label, "page_size": page_size, "quarantine_threshold": quarantine_threshold,
+                                                  "dry_run": dry_run, "quarantine_label": quarantine_label})
+    return job_view(state)
+
+@app.get("/jobs", dependencies=[Depends(verify_api_key)])
+async def list_jobs(email: str):
+    return {"items": [job_view(s) for s in jobs.list(email)]}
+
+@app.get("/jobs/{job_id}", dependencies=[Depends(verify_api_key)])
+async def get_job(job_id: str, offset: int = 0, limit: int = 200):
+    """Job status plus up to `limit` results from `offset`; `next_offset` is null once caught up."""
+    state = jobs.get(job_id)
+    if state is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    items, next_offset = jobs.results(job_id, offset=offset, limit=limit)
+    return {**job_view(state), "items": items, "next_offset": next_offset}
+
+@app.post("/jobs/{job_id}/cancel", dependencies=[Depends(verify_api_key)])
+async def cancel_job(job_id: str):
+    if jobs.get(job_id) is None:
+        raise HTTPException(status_code=404, detail="Unknown job")
+    return job_view(jobs.cancel(job_id))
+
+# ---------- Scheduler ----------
+_sweep_locks: Dict[str, asyncio.Lock] = {}
+SWEEP_LOCK_DIR = DATA_DIR / "sweeps"
+SWEEP_LOCK_POLL = 0.5  # seconds between tries while another process sweeps the account
+
+async def sweep_account(email: str):
+    """Incremental classification of one account's inbox; the account's shadow flag decides whether to act.
+
+    Run by the scheduler and by push notifications, never twice at once for the same account:
+    not in this process (an asyncio lock) nor in others sharing DATA_DIR (`sweeps/<key>.lock`).
+    """
+    async with _sweep_locks.setdefault(email, asyncio.Lock()):
+        SWEEP_LOCK_DIR.mkdir(exist_ok=True)
+        lock = LeaderLock(SWEEP_LOCK_DIR / f"{user_key(email)}.lock", announce=False)
+        while not lock.held():
+            await asyncio.sleep(SWEEP_LOCK_POLL)
+        try:
+            await batch_classify(email, "INBOX", SCHEDULER_MAX_RESULTS, dry_run=False, incremental=True)
+        finally:
+            lock.release()
+
+scheduler = Scheduler(list_accounts, sweep_account, interval=SCHEDULER_INTERVAL, concurrency=SCHEDULER_CONCURRENCY,
+                      jitter=SCHEDULER_JITTER, max_backoff=SCHEDULER_MAX_BACKOFF, leader=scheduler_lock)
+
+@app.get("/scheduler", dependencies=[Depends(verify_api_key)])
+async def scheduler_status():
+    return {"interval": SCHEDULER_INTERVAL, "leader": scheduler_lock.holding, "accounts": scheduler.status(), "watches": watcher.status(), "push": push.status()}
+
+# ---------- Push ----------
+async def renew_watch(email: str) -> Dict[str, Any]:
+    """Register (or renew) the account's Gmail watch on its inbox, published to GMAIL_PUSH_TOPIC."""
+    return await gmail.watch(email, GMAIL_PUSH_TOPIC, ["INBOX"])
+
+# Watches are renewed on their own schedule, by the scheduler's leader only; with no topic
+# configured the loop never starts.
+watcher = Scheduler(list_accounts, renew_watch, interval=GMAIL_WATCH_RENEW if GMAIL_PUSH_TOPIC else 0,
+                    concurrency=SCHEDULER_CONCURRENCY, jitter=SCHEDULER_JITTER, max_backoff=GMAIL_WATCH_RENEW, leader=scheduler_lock)
+push = PushDispatcher(sweep_account)
+
+@app.post("/gmail/watch", dependencies=[Depends(verify_api_key)])
+async def gmail_watch(email: str = Body(..., embed=True)):
+    if not GMAIL_PUSH_TOPIC:
+        raise HTTPException(status_code=400, detail="GMAIL_PUSH_TOPIC is not configured")
+    try:
+        return await renew_watch(email)
+    except Exception as e:
+        raise http_error(e)
+
+# Open like the OAuth callback (Pub/Sub cannot send X-API-Key); the subscription URL carries ?token= instead.
+@app.post("/gmail/push")
+async def gmail_push(envelope: Dict[str, Any] = Body(...), token: str = Query("")):
+    """Pub/Sub push endpoint: queue an incremental sweep of the notified account.
+
+    Anything other than a 2xx makes Pub/Sub redeliver, so notifications that can never be
+    processed (malformed, unknown account, already covered by the checkpoint) are acknowledged.
+    """
+    if not GMAIL_PUSH_TOKEN:
+        raise HTTPException(status_code=500, detail="Push token not configured")
+    if token != GMAIL_PUSH_TOKEN:
+        raise HTTPException(status_code=401, detail="Invalid or missing push token")
+    try:
+        email, history_id = decode_push(envelope)
+    except ValueError as e:
+        return {"ok": False, "ignored": str(e)}
+    if not has_tokens(email):
+        return {"ok": False, "ignored": "unknown account"}
+    checkpoint = load_checkpoint(email, "sweep", "INBOX")
+    if checkpoint and history_id <= int(checkpoint):
+        return {"ok": True, "queued": False}
+    return {"ok": True, "queued": push.notify(email)}
@@ -0,0 +1,62 @@
+"""Multi-keyword matching with an Aho–Corasick automaton.
+
+The keywords are compiled once into a trie with failure links; `finditer` then reports every
+occurrence of every keyword, overlapping ones included, in a single left-to-right pass. The
+cost of a scan depends on the length of the text and the number of hits, not on how many
+keywords there are, which an alternation regex cannot promise once the lists run into the
+thousands. Matching is exact: callers fold case on both sides beforehand.
+"""
+from collections import deque
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+
+class KeywordMatcher:
+    """Built from (keyword, payload) pairs; each hit reports the payload of the keyword found."""
+
+    def __init__(self, keywords: Iterable[Tuple[str, Any]]):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._out: List[List[Tuple[int, Any]]] = [[]]  # (keyword length, payload) ending in each state
+        for word, payload in keywords:
+            if not word:
+                continue
+            state = 0
+            for ch in word:
+                nxt = self._goto[state].get(ch)
+                if nxt is None:
+                    nxt = self._goto[state][ch] = len(self._goto)
+                    self._goto.append({})
+                    self._out.append([])
+                state = nxt
+            self._out[state].append((len(word), payload))
+        self._fail = [0] * len(self._goto)
+        self._link()
+
+    def _link(self):
+        """Set failure links breadth-first; each state also inherits the hits of its fallback."""
+        goto, fail, out = self._goto, self._fail, self._out
+        queue = deque(goto[0].values())  # depth-1 states fall back to the root
+        while queue:
+            state = queue.popleft()
+            for ch, nxt in goto[state].items():
+                queue.append(nxt)
+                f = fail[state]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0)
+                if out[fail[nxt]]:
+                    out[nxt] = out[nxt] + out[fail[nxt]]
+
+    def __len__(self) -> int:
+        return len(self._goto) - 1  # states other than the root
+
+    def finditer(self, text: str) -> Iterator[Tuple[int, int, Any]]:
+        """Yield (start, end, payload) for every keyword occurrence, in order of `end`."""
+        goto, fail, out = self._goto, self._fail, self._out
+        state = 0
+        for i, ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if out[state]:
+                for length, payload in out[state]:
+                    yield i + 1 - length, i + 1, payload
@@ -0,0 +1,166 @@
+"""Optional learned scoring stage: logistic regression over hashed message features.
+
+Features are the subject's tokens, the sender's domain and its parent domains, and which
+headers are present, each hashed into 2**bits buckets. `train` fits the weights on labelled
+messages (quarantined = 1, restored = 0, see `labels_from_audit`) and writes them to a single
+file: a small header followed by the float32 weights. `LinearModel` memory-maps that file on
+first use rather than reading it, so worker startup does not pay for the model, and reloads it
+when a newer one is written.
+"""
+import hashlib, logging, math, mmap, os, random, re, struct, tempfile, threading, zlib
+from array import array
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from .rules import domain_suffixes, sender_parts
+
+log = logging.getLogger("siftmail.model")
+
+HEADER = struct.Struct("<4sI8sf")  # magic, bits, version, bias
+MAGIC = b"SFT1"
+DEFAULT_BITS = 18
+
+# Manual actions only. Entries written by classification carry a "score" without "reasons"
+# (a manual quarantine may record both) and would teach the model to agree with the heuristics
+# rather than with the user.
+LABEL_EVENTS = {"quarantine": 1, "would_quarantine": 1, "restore": 0, "would_restore": 0}
+
+_TOKEN = re.compile(r"[^\W_]{2,}")
+
+# Second-level suffixes under which anyone can register a domain. Together with bare TLDs they
+# say nothing about the sender, and as features they would tie together unrelated mail.
+PUBLIC_SUFFIXES = {
+    "ac.uk", "co.uk", "gov.uk", "ltd.uk", "me.uk", "net.uk", "org.uk", "plc.uk",
+    "com.au", "net.au", "org.au", "edu.au", "gov.au", "co.nz", "net.nz", "org.nz",
+    "co.jp", "ne.jp", "or.jp", "ac.jp", "co.kr", "or.kr", "com.cn", "net.cn", "org.cn",
+    "com.hk", "com.sg", "com.tw", "com.my", "com.ph", "co.id", "co.th", "co.in", "net.in",
+    "org.in", "com.br", "net.br", "org.br", "com.mx", "com.ar", "com.co", "com.pe", "com.tr",
+    "co.za", "co.il", "com.eg", "com.ng", "com.pk", "com.ua", "com.ru", "com.pl", "co.at",
+}
+
+
+def sender_domains(dom: str) -> List[str]:
+    """The sender's domain and its parents, down to the registrable one (no TLDs, no public suffixes)."""
+    return [d for d in domain_suffixes(dom) if "." in d and d not in PUBLIC_SUFFIXES]
+
+Record = Tuple[Dict[str, str], Optional[str]]  # (headers, snippet), as scored by RuleSet
+
+
+def features(headers: Dict[str, str], bits: int, presence: bool = True) -> List[int]:
+    """Distinct hashed feature indices of a message.
+
+    With `presence`, the model's feature set: every domain suffix down to the TLD, plus one
+    feature per non-empty header. Without it, the learner's: only features that tell one
+    sender or subject from another (see `sender_domains`).
+    """
+    mask = (1 << bits) - 1
+    names = [f"s:{t}" for t in _TOKEN.findall((headers.get("Subject") or "").lower())]
+    _, dom = sender_parts(headers)
+    if presence:
+        names += [f"d:{d}" for d in domain_suffixes(dom)]
+        names += [f"h:{h.lower()}" for h, v in headers.items() if v]
+    else:
+        names += [f"d:{d}" for d in sender_domains(dom)]
+    return list({zlib.crc32(n.encode()) & mask for n in names})
+
+
+def _sigmoid(z: float) -> float:
+    return 1.0 / (1.0 + math.exp(-max(-30.0, min(30.0, z))))
+
+
+def labels_from_audit(entries: Iterable[dict]) -> Dict[str, int]:
+    """Message id -> label from audit entries (oldest first); the latest manual action wins."""
+    labels: Dict[str, int] = {}
+    for entry in entries:
+        label = LABEL_EVENTS.get(entry.get("event"))
+        if label is not None and ("score" not in entry or "reasons" in entry) and entry.get("id"):
+            labels[entry["id"]] = label
+    return labels
+
+
+def train(examples: Sequence[Tuple[Dict[str, str], int]], path: Path, bits: int = DEFAULT_BITS,
+          epochs: int = 5, rate: float = 0.1, l2: float = 1e-6) -> Dict[str, object]:
+    """Fit weights on (headers, label) pairs by SGD and atomically replace the model at `path`."""
+    weights = array("f", bytes(4 << bits))
+    bias = 0.0
+    rows = [(features(h, bits), y) for h, y in examples]
+    order = list(range(len(rows)))
+    rnd = random.Random(0)
+    for epoch in range(epochs):
+        rnd.shuffle(order)
+        step = rate / (1 + epoch)
+        for i in order:
+            idx, y = rows[i]
+            g = _sigmoid(bias + sum(weights[j] for j in idx)) - y
+            bias -= step * g
+            for j in idx:
+                weights[j] -= step * (g + l2 * weights[j])
+    blob = weights.tobytes()
+    version = hashlib.sha1(blob + struct.pack("<f", bias)).hexdigest()[:8]
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=path.name, suffix=".tmp")
+    with os.fdopen(fd, "wb") as f:
+        f.write(HEADER.pack(MAGIC, bits, version.encode(), bias))
+        f.write(blob)
+    os.replace(tmp, path)
+    positives = sum(y for _, y in examples)
+    return {"version": version, "examples": len(examples), "positives": positives, "negatives": len(examples) - positives, "bits": bits}
+
+
+class LinearModel:
+    """A model file, mapped lazily; `version` is None (and scoring unaffected) while there is none."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._stamp: Optional[Tuple[int, int]] = None
+        self._map: Optional[mmap.mmap] = None
+        self._weights: Optional[memoryview] = None
+        self._bits = 0
+        self._bias = 0.0
+        self._version: Optional[str] = None
+
+    def _load(self):
+        """(Re)map the file when it has changed since the last call."""
+        try:
+            st = self.path.stat()
+            stamp = (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            stamp = None
+        if stamp == self._stamp:
+            return
+        with self._lock:
+            if stamp == self._stamp:
+                return
+            # a batch still scoring with the old weights keeps its mapping alive until it is done
+            self._version, self._weights, self._map = None, None, None
+            self._stamp = stamp
+            if stamp is None:
+                return
+            mm = None
+            with self.path.open("rb") as f:  # the mapping stays valid once the file is closed
+                try:
+                    mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                    magic, bits, version, bias = HEADER.unpack_from(mm)
+                except (ValueError, struct.error):
+                    magic = None
+            if magic != MAGIC or len(mm) != HEADER.size + (4 << bits):
+                if mm is not None:
+                    mm.close()
+                log.warning("ignoring %s: not a model file", self.path)  # scored by the heuristics alone until replaced
+                return
+            self._map, self._bits, self._bias, self._version = mm, bits, bias, version.decode()
+            self._weights = memoryview(mm)[HEADER.size:].cast("f")
+
+    @property
+    def version(self) -> Optional[str]:
+        self._load()
+        return self._version
+
+    def predict_batch(self, records: Iterable[Record]) -> Optional[List[float]]:
+        """Spam probability of each (headers, snippet) record, or None when no model is deployed."""
+        self._load()
+        weights, bits, bias = self._weights, self._bits, self._bias
+        if weights is None:
+            return None
+        return [_sigmoid(bias + sum(weights[j] for j in features(headers, bits))) for headers, _ in records]
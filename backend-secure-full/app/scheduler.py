@@ -0,0 +1,147 @@
+"""In-process scheduler that runs a per-account task for every connected account on a cadence.
+
+Accounts are visited round-robin: each tick scans from where the previous one left off, so
+when more accounts are due than there are free slots, the ones skipped go first next time.
+First runs are spread over `jitter` seconds instead of all firing at startup, and an account
+whose run fails waits `interval * 2**failures` (capped at `max_backoff`) before the next try.
+
+With several server processes, give every scheduler the same `LeaderLock`: only the process
+holding it runs anything, and when that process exits another one takes over within a tick.
+The account list is re-read every `refresh` seconds, in a thread.
+"""
+import asyncio, fcntl, logging, random, time
+from collections import deque
+from pathlib import Path
+from typing import IO, Awaitable, Callable, Deque, Dict, Iterable, Optional, Set
+
+log = logging.getLogger("siftmail.scheduler")
+
+
+class LeaderLock:
+    """An flock on `path` that one process at a time holds until it exits (or calls `release`)."""
+
+    def __init__(self, path: Path, announce: bool = True):
+        self.path = path
+        self.announce = announce  # log when this process takes the lock
+        self._file: Optional[IO] = None
+
+    @property
+    def holding(self) -> bool:
+        return self._file is not None
+
+    def held(self) -> bool:
+        """Whether this process holds the lock, taking it without waiting if nobody does."""
+        if self._file is None:
+            f = open(self.path, "a")
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                f.close()
+                return False
+            self._file = f
+            if self.announce:
+                log.info("this process now runs scheduled work (%s)", self.path)
+        return True
+
+    def release(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class Scheduler:
+    def __init__(self, accounts: Callable[[], Iterable[str]], run: Callable[[str], Awaitable[object]],
+                 interval: float, concurrency: int = 4, jitter: float = 30.0, max_backoff: float = 3600.0, tick: float = 1.0,
+                 refresh: float = 30.0, leader: Optional[LeaderLock] = None):
+        self._accounts = accounts
+        self._run = run
+        self._leader = leader
+        self.interval = interval
+        self.concurrency = concurrency
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+        self.tick = tick
+        self.refresh = refresh
+        self._listed: Optional[float] = None
+        self._order: Deque[str] = deque()
+        self._due: Dict[str, float] = {}
+        self._failures: Dict[str, int] = {}
+        self._active: Set[str] = set()
+        self._inflight: Set[asyncio.Task] = set()
+        self._task: Optional[asyncio.Task] = None
+
+    def _sync_accounts(self, now: float, current: Set[str]):
+        for email in current - set(self._due):
+            self._order.append(email)
+            self._due[email] = now + random.uniform(0, self.jitter)
+        for email in set(self._due) - current:
+            self._order.remove(email)
+            self._due.pop(email, None)
+            self._failures.pop(email, None)
+
+    def status(self) -> Dict[str, Dict[str, float]]:
+        """Seconds until each account's next run and its consecutive failures."""
+        now = time.monotonic()
+        return {e: {"next_run_in": max(0.0, round(due - now, 1)), "failures": self._failures.get(e, 0), "running": e in self._active}
+                for e, due in self._due.items()}
+
+    async def _run_one(self, email: str):
+        try:
+            await self._run(email)
+            self._failures.pop(email, None)
+            delay = self.interval
+        except Exception as e:
+            failures = self._failures[email] = self._failures.get(email, 0) + 1
+            delay = min(self.interval * 2 ** failures, self.max_backoff)
+            log.warning("scheduled run failed for %s (%d in a row, next in %.0fs): %s", email, failures, delay, e)
+        finally:
+            self._active.discard(email)
+        if email in self._due:
+            self._due[email] = time.monotonic() + delay + random.uniform(0, self.jitter)
+
+    async def _refresh_accounts(self):
+        now = time.monotonic()
+        if self._listed is None or now - self._listed >= self.refresh:
+            current = set(await asyncio.to_thread(self._accounts))  # may scan the whole state store
+            self._sync_accounts(time.monotonic(), current)
+            self._listed = now
+
+    def run_due(self):
+        """One tick: start runs for due accounts, round-robin, up to the concurrency cap."""
+        now = time.monotonic()
+        for _ in range(len(self._order)):
+            if len(self._active) >= self.concurrency:
+                break
+            email = self._order[0]
+            self._order.rotate(-1)
+            if email in self._active or self._due[email] > now:
+                continue
+            self._active.add(email)
+            task = asyncio.create_task(self._run_one(email))
+            self._inflight.add(task)
+            task.add_done_callback(self._inflight.discard)
+
+    async def _loop(self):
+        while True:
+            try:
+                if self._leader is None or self._leader.held():
+                    await self._refresh_accounts()
+                    self.run_due()
+            except Exception as e:
+                log.warning("scheduler tick failed: %s", e)
+            await asyncio.sleep(self.tick)
+
+    def start(self):
+        if self.interval > 0 and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        tasks = [t for t in [self._task, *self._inflight] if t is not None]
+        for t in tasks:
+            t.cancel()
+        for t in tasks:
+            try:
+                await t
+            except asyncio.CancelledError:
+                pass
+        self._task = None
@@ -0,0 +1,269 @@
+"""Local cache of message metadata and scores, one SQLite file shared by every account.
+
+Gmail never changes a message's headers or snippet, so metadata is stored once per
+(user, message) and scores once per (user, message, RuleSet.version). Editing rules changes the
+version: old scores are no longer looked up (and are pruned on the next write) while the cached
+metadata is rescored locally, without another Gmail fetch.
+
+Every stored message is also indexed for local search: a `messages` row with its date, sender,
+sender domain, last score and whether we moved it to quarantine, and an FTS5 index over its
+subject, From header and snippet. Searches and aggregates over mail we have already fetched are
+answered from here and never reach Gmail; they only cover what has been fetched, which
+`freshness` reports.
+"""
+import json, re, sqlite3, threading, time
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .rules import sender_parts
+
+CHUNK = 500  # ids per IN (...) query; stays under SQLite's bound-parameter limit
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (
+    user TEXT NOT NULL,
+    id TEXT NOT NULL,
+    data TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    PRIMARY KEY (user, id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS scores (
+    user TEXT NOT NULL,
+    id TEXT NOT NULL,
+    version TEXT NOT NULL,
+    score REAL NOT NULL,
+    reasons TEXT NOT NULL,
+    PRIMARY KEY (user, id, version)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS messages (
+    rowid INTEGER PRIMARY KEY,
+    user TEXT NOT NULL,
+    id TEXT NOT NULL,
+    date INTEGER NOT NULL,
+    sender TEXT NOT NULL,
+    address TEXT NOT NULL,
+    domain TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    snippet TEXT NOT NULL,
+    score REAL,
+    quarantined INTEGER NOT NULL DEFAULT 0,
+    ts INTEGER NOT NULL,
+    UNIQUE (user, id)
+);
+CREATE INDEX IF NOT EXISTS messages_date ON messages (user, date);
+CREATE INDEX IF NOT EXISTS messages_domain ON messages (user, domain, date);
+CREATE INDEX IF NOT EXISTS messages_score ON messages (user, score);
+CREATE INDEX IF NOT EXISTS messages_ts ON messages (user, ts);
+CREATE INDEX IF NOT EXISTS messages_quarantined ON messages (user, domain) WHERE quarantined;
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+    subject, sender, snippet, content='messages', content_rowid='rowid',
+    tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+);
+CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, subject, sender, snippet) VALUES (new.rowid, new.subject, new.sender, new.snippet);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, subject, sender, snippet) VALUES ('delete', old.rowid, old.subject, old.sender, old.snippet);
+END;
+"""
+
+# Columns of a search result, in the order selected.
+MESSAGE_FIELDS = ("id", "date", "from", "address", "domain", "subject", "snippet", "score", "quarantined", "indexed")
+
+_WORD = re.compile(r"(\w+)(\*?)")
+
+
+def _match(text: str) -> Optional[str]:
+    """FTS5 query for free text: every word must occur; `word*` matches words starting with it."""
+    words = _WORD.findall(text)
+    return " ".join(f'"{w}"{star}' for w, star in words) if words else None
+
+
+def _message_row(user: str, m: Dict[str, Any], now: int) -> tuple:
+    headers = m.get("headers") or {}
+    address, domain = sender_parts(headers)
+    try:
+        date = int(m.get("internalDate")) // 1000
+    except (TypeError, ValueError):
+        date = now
+    return (user, m["id"], date, headers.get("From") or "", address, domain, headers.get("Subject") or "", m.get("snippet") or "", now)
+
+
+def _chunks(ids: List[str]) -> Iterator[List[str]]:
+    for i in range(0, len(ids), CHUNK):
+        yield ids[i:i + CHUNK]
+
+
+class ScoreCache:
+    """Thread-safe. Writes share one connection behind a lock; reads use a connection per thread,
+    which under WAL neither waits for the writer nor holds it up."""
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._versions: Dict[str, str] = {}
+        self._local = threading.local()
+        self._readers: List[sqlite3.Connection] = []
+        self._readers_lock = threading.Lock()
+        self._generation = 0  # bumped by close(), so threads reopen their reader
+
+    def _conn(self) -> sqlite3.Connection:
+        if self._db is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            db = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            indexed = db.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages'").fetchone()
+            db.executescript(SCHEMA)
+            if not indexed:  # a cache from before the search index: index what it already holds
+                rows = [_message_row(user, json.loads(data), ts) for user, data, ts in db.execute("SELECT user, data, ts FROM metadata")]
+                self._index(db, rows)
+            self._db = db
+        return self._db
+
+    def _reader(self) -> sqlite3.Connection:
+        """This thread's read-only connection, opened on first use."""
+        gen, db = getattr(self._local, "reader", (None, None))
+        if db is None or gen != self._generation:
+            if self._db is None:
+                with self._lock:
+                    self._conn()  # creates the file and schema
+            db = sqlite3.connect(self.path.resolve().as_uri() + "?mode=ro", uri=True, check_same_thread=False, isolation_level=None)
+            with self._readers_lock:
+                self._readers.append(db)
+                self._local.reader = (self._generation, db)
+        return db
+
+    @staticmethod
+    def _select(db: sqlite3.Connection, sql: str, user: str, ids: List[str], *extra: Any) -> Iterator[tuple]:
+        for chunk in _chunks(list(dict.fromkeys(ids))):
+            marks = ",".join("?" * len(chunk))
+            yield from db.execute(sql.format(marks=marks), (user, *extra, *chunk))
+
+    def metadata(self, user: str, ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        rows = list(self._select(self._reader(), "SELECT id, data FROM metadata WHERE user = ? AND id IN ({marks})", user, ids))
+        return {mid: json.loads(data) for mid, data in rows}
+
+    @staticmethod
+    def _index(db: sqlite3.Connection, rows: List[tuple]):
+        # an upsert rather than REPLACE, which would delete the row without telling the FTS index
+        db.executemany("INSERT INTO messages (user, id, date, sender, address, domain, subject, snippet, ts) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                       "ON CONFLICT (user, id) DO UPDATE SET ts = excluded.ts", rows)
+
+    def store_metadata(self, user: str, metas: Iterable[Dict[str, Any]]):
+        metas = list(metas)
+        now = int(time.time())
+        rows = [(user, m["id"], json.dumps(m), now) for m in metas]
+        if rows:
+            with self._lock:
+                db = self._conn()
+                db.execute("BEGIN")
+                try:
+                    db.executemany("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)", rows)
+                    self._index(db, [_message_row(user, m, now) for m in metas])
+                    db.execute("COMMIT")
+                except BaseException:
+                    db.execute("ROLLBACK")
+                    raise
+
+    def scores(self, user: str, ids: List[str], version: str) -> Dict[str, Dict[str, Any]]:
+        rows = list(self._select(self._reader(), "SELECT id, score, reasons FROM scores WHERE user = ? AND version = ? AND id IN ({marks})",
+                                 user, ids, version))
+        return {mid: {"score": score, "reasons": json.loads(reasons)} for mid, score, reasons in rows}
+
+    def store_scores(self, user: str, version: str, items: Iterable[Tuple[str, Dict[str, Any]]]):
+        rows = [(user, mid, version, sc["score"], json.dumps(sc["reasons"])) for mid, sc in items]
+        if not rows:
+            return
+        with self._lock:
+            db = self._conn()
+            if self._versions.get(user) != version:
+                # scores under any other version can never be looked up again
+                db.execute("DELETE FROM scores WHERE user = ? AND version <> ?", (user, version))
+                self._versions[user] = version
+            db.executemany("INSERT OR REPLACE INTO scores VALUES (?, ?, ?, ?, ?)", rows)
+            db.executemany("UPDATE messages SET score = ? WHERE user = ? AND id = ?", [(r[3], user, r[1]) for r in rows])
+
+    def mark_quarantined(self, user: str, ids: List[str], quarantined: bool = True):
+        """Record that messages were moved into (or back out of) quarantine."""
+        with self._lock:
+            self._conn().executemany("UPDATE messages SET quarantined = ? WHERE user = ? AND id = ?", [(int(quarantined), user, mid) for mid in ids])
+
+    def search(self, user: str, text: Optional[str] = None, domain: Optional[str] = None, since: Optional[int] = None,
+               until: Optional[int] = None, min_score: Optional[float] = None, quarantined: Optional[bool] = None,
+               limit: int = 50, offset: int = 0) -> List[Dict[str, Any]]:
+        """Indexed messages of `user`, newest first; `text` is matched against subject, From and snippet."""
+        sql = ("SELECT m.id, m.date, m.sender, m.address, m.domain, m.subject, m.snippet, m.score, m.quarantined, m.ts "
+               "FROM messages m")
+        where, args = ["m.user = ?"], [user]
+        match = _match(text) if text else None
+        if match:
+            # matched once as a set: joined, SQLite may probe the index per row of the user's mail instead
+            where.append("m.rowid IN (SELECT rowid FROM messages_fts WHERE messages_fts MATCH ?)")
+            args.append(match)
+        if domain:
+            where.append("m.domain = ?")
+            args.append(domain.lower())
+        if since is not None:
+            where.append("m.date >= ?")
+            args.append(since)
+        if until is not None:
+            where.append("m.date <= ?")  # inclusive, like the audit log's
+            args.append(until)
+        if min_score is not None:
+            where.append("m.score >= ?")
+            args.append(min_score)
+        if quarantined is not None:
+            where.append("m.quarantined = ?")
+            args.append(int(quarantined))
+        sql += " WHERE " + " AND ".join(where) + " ORDER BY m.date DESC, m.rowid DESC LIMIT ? OFFSET ?"
+        rows = self._reader().execute(sql, (*args, limit, offset)).fetchall()
+        return [dict(zip(MESSAGE_FIELDS, r[:8] + (bool(r[8]), r[9]))) for r in rows]
+
+    def top_senders(self, user: str, limit: int = 20) -> List[Dict[str, Any]]:
+        """Sender domains of `user` ranked by how many of their messages we quarantined."""
+        rows = self._reader().execute(
+            "SELECT domain, COUNT(*) AS n FROM messages WHERE user = ? AND quarantined GROUP BY domain ORDER BY n DESC, domain LIMIT ?",
+            (user, limit)).fetchall()
+        return [{"domain": dom, "quarantined": n} for dom, n in rows]
+
+    def freshness(self, user: str) -> Dict[str, Any]:
+        """How much of `user`'s mail is indexed and when it was last added to."""
+        db = self._reader()
+        db.execute("BEGIN")  # one snapshot for all three
+        try:
+            # three queries, so each of the maxima is read off the end of its index
+            count, = db.execute("SELECT COUNT(*) FROM messages WHERE user = ?", (user,)).fetchone()
+            newest, = db.execute("SELECT MAX(ts) FROM messages WHERE user = ?", (user,)).fetchone()
+            latest, = db.execute("SELECT MAX(date) FROM messages WHERE user = ?", (user,)).fetchone()
+        finally:
+            db.execute("COMMIT")
+        return {"indexed": count, "last_indexed": newest, "newest_message": latest}
+
+    def prune(self, older_than: float):
+        """Drop metadata (and its scores) cached before `older_than` (epoch seconds)."""
+        with self._lock:
+            db = self._conn()
+            db.execute("DELETE FROM scores WHERE (user, id) IN (SELECT user, id FROM metadata WHERE ts < ?)", (int(older_than),))
+            db.execute("DELETE FROM metadata WHERE ts < ?", (int(older_than),))
+            db.execute("DELETE FROM messages WHERE ts < ?", (int(older_than),))
+
+    def purge(self, user: str):
+        with self._lock:
+            db = self._conn()
+            db.execute("DELETE FROM scores WHERE user = ?", (user,))
+            db.execute("DELETE FROM metadata WHERE user = ?", (user,))
+            db.execute("DELETE FROM messages WHERE user = ?", (user,))
+            self._versions.pop(user, None)
+
+    def close(self):
+        with self._readers_lock:
+            for db in self._readers:
+                db.close()
+            self._readers = []
+            self._generation += 1
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,24 @@
+import pytest
+
+from app.audit import AuditWriter
+
+
+def test_failed_write_keeps_the_entries_in_order():
+    written, failing = [], [True]
+
+    def write(email, lines):
+        if failing[0]:
+            raise OSError("disk full")
+        written.extend(lines)
+        return list(enumerate(lines))
+
+    writer = AuditWriter(write)
+    writer.append("a@example.com", {"n": 1})
+    with pytest.raises(OSError):
+        writer.flush()
+    assert writer.pending
+    writer.append("a@example.com", {"n": 2})
+    failing[0] = False
+    writer.flush()
+    assert written == ['{"n": 1}\n', '{"n": 2}\n']
+    assert not writer.pending
@@ -0,0 +1,27 @@
+import asyncio
+
+import httpx
+
+from app.gmail_client import GmailClient, GmailError
+from conftest import FakeGmail
+
+
+def test_a_failed_chunk_costs_only_its_own_ids():
+    fake = FakeGmail()
+    for i in range(6):
+        fake.add(f"m{i}", "Bob <bob@example.com>", "Lunch")
+    fake.fail_ids = {"m3"}
+
+    async def token(email, force=False):
+        return "token"
+
+    async def fetch():
+        client = GmailClient(token, max_retries=1, retry_base=0.01, transport=httpx.MockTransport(fake.handler))
+        try:
+            return await client.get_metadata_batch("user@example.com", [f"m{i}" for i in range(6)], ["From"], chunk_size=2)
+        finally:
+            await client.aclose()
+
+    found = asyncio.run(fetch())
+    assert [m["id"] for m in found[:2] + found[4:]] == ["m0", "m1", "m4", "m5"]
+    assert all(isinstance(e, GmailError) and e.status == 500 for e in found[2:4])
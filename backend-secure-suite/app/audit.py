@@ -0,0 +1,194 @@
+"""Append-only JSONL audit logs, read from the tail, and the buffered writer in front of them.
+
+Cursors are byte offsets into the log: a page ends at the cursor and the next cursor is the
+offset of the oldest line returned, so paging back through history never re-reads newer lines.
+The offset just past an entry also identifies it in event streams (see `read_after`). Entries
+kept in the SQLite state store (app/store.py) use their row id for both instead.
+"""
+import asyncio, json, logging, threading
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+log = logging.getLogger("siftmail.audit")
+
+BLOCK_SIZE = 64 * 1024
+
+
+def lines_backwards(p: Path, end: Optional[int] = None, block_size: int = BLOCK_SIZE) -> Iterator[Tuple[int, bytes]]:
+    """Yield (offset, line) pairs from byte offset `end` (default: end of file) back to the start."""
+    with p.open("rb") as f:
+        pos = f.seek(0, 2) if end is None else end
+        tail = b""
+        while pos > 0:
+            size = min(block_size, pos)
+            pos -= size
+            f.seek(pos)
+            lines = (f.read(size) + tail).split(b"\n")
+            tail = lines[0]  # may continue in the previous block
+            off = pos + len(tail) + 1
+            found = []
+            for line in lines[1:]:
+                found.append((off, line))
+                off += len(line) + 1
+            for item in reversed(found):
+                if item[1].strip():
+                    yield item
+        if tail.strip():
+            yield 0, tail
+
+
+def read_page(p: Path, limit: int = 200, cursor: Optional[int] = None, events: Optional[Iterable[str]] = None,
+              since: Optional[int] = None, until: Optional[int] = None) -> Tuple[List[dict], Optional[int]]:
+    """Return up to `limit` entries older than `cursor`, oldest first, plus the cursor for the next page.
+
+    `events` keeps only those event types; `since`/`until` bound the entry `ts` (inclusive).
+    Entries are appended in time order, so the scan stops at the first entry older than `since`.
+    """
+    if limit <= 0 or not p.exists():
+        return [], None
+    wanted = set(events) if events else None
+    items: List[dict] = []
+    next_cursor: Optional[int] = None
+    for off, line in lines_backwards(p, cursor):
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            continue
+        ts = entry.get("ts", 0)
+        if since is not None and ts < since:
+            break
+        if (until is not None and ts > until) or (wanted is not None and entry.get("event") not in wanted):
+            continue
+        items.append(entry)
+        if len(items) == limit:
+            next_cursor = off or None
+            break
+    items.reverse()
+    return items, next_cursor
+
+
+def read_after(p: Path, offset: int) -> List[Tuple[int, str]]:
+    """(end offset, line) of every complete entry written at or after byte offset `offset`, oldest first."""
+    if not p.exists():
+        return []
+    found = []
+    with p.open("rb") as f:
+        f.seek(offset)
+        for raw in f:
+            offset += len(raw)
+            if raw.endswith(b"\n") and raw.strip():
+                found.append((offset, raw.decode().rstrip("\n")))
+    return found
+
+
+def append_lines(p: Path, lines: List[str]) -> List[Tuple[int, str]]:
+    """Append newline-terminated `lines` with one write; (end offset, line without newline) of each."""
+    data = "".join(lines).encode()
+    with p.open("ab", buffering=0) as f:
+        f.write(data)
+        pos = f.tell() - len(data)  # O_APPEND: our bytes end here even if another worker appended first
+    written = []
+    for line in lines:
+        pos += len(line.encode())
+        written.append((pos, line[:-1]))
+    return written
+
+
+class AuditWriter:
+    """Buffers audit entries per user and appends each user's buffer with a single write.
+
+    `append` only touches the disk when a user's buffer reaches `max_pending` (from a thread when
+    called on the event loop). Buffers are flushed by `flush()` (after each request, before reads,
+    on shutdown) and by the background loop every `interval` seconds. A user's entries are
+    written in append order: whoever flushes holds that user's lock while taking and writing the
+    whole buffer, and puts it back in front if the write fails. `write(email, lines)` stores the
+    lines in one go (one write per flush keeps lines whole when several workers append to the
+    same file) and returns (id, line) for each.
+
+    `on_write(email, [(id, line), ...])` is called after each write with the entries just
+    written, still under the user's lock, so it sees them in log order.
+    """
+
+    def __init__(self, write: Callable[[str, List[str]], List[Tuple[int, str]]], interval: float = 0.5, max_pending: int = 1000,
+                 on_write: Optional[Callable[[str, List[Tuple[int, str]]], None]] = None):
+        self._write = write
+        self.on_write = on_write
+        self.interval = interval
+        self.max_pending = max_pending
+        self._pending: Dict[str, List[str]] = {}
+        self._lock = threading.Lock()
+        self._user_locks: Dict[str, threading.Lock] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def pending(self) -> bool:
+        return bool(self._pending)
+
+    def append(self, email: str, entry: dict):
+        line = json.dumps(entry) + "\n"
+        with self._lock:
+            buf = self._pending.setdefault(email, [])
+            buf.append(line)
+            full = len(buf) >= self.max_pending
+        if full:
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self.flush(email)  # already off the event loop
+            else:
+                loop.run_in_executor(None, self.flush, email)  # the write may wait on a lock
+
+    def _user_lock(self, email: str) -> threading.Lock:
+        with self._lock:
+            return self._user_locks.setdefault(email, threading.Lock())
+
+    def flush(self, email: Optional[str] = None):
+        """Write out buffered entries for one user, or for everyone."""
+        with self._lock:
+            emails = [email] if email is not None else list(self._pending)
+        for e in emails:
+            with self._user_lock(e):
+                with self._lock:
+                    lines = self._pending.pop(e, None)
+                if lines:
+                    try:
+                        written = self._write(e, lines)
+                    except BaseException:
+                        with self._lock:  # ahead of anything appended meanwhile, for the next flush
+                            self._pending[e] = lines + self._pending.get(e, [])
+                        raise
+                    if self.on_write is not None:
+                        self._notify(e, written)
+
+    def _notify(self, email: str, written: List[Tuple[int, str]]):
+        try:
+            self.on_write(email, written)
+        except Exception as e:
+            log.warning("audit on_write failed: %s", e)
+
+    def discard(self, email: str):
+        with self._user_lock(email), self._lock:
+            self._pending.pop(email, None)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            if self._pending:
+                try:
+                    await asyncio.to_thread(self.flush)
+                except Exception as e:
+                    log.warning("audit flush failed: %s", e)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self.flush()
@@ -0,0 +1,91 @@
+"""Small in-process caches shared by the request handlers."""
+import copy, json, os, threading, time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Callable, Generic, Hashable, Optional, Tuple, TypeVar
+
+V = TypeVar("V")
+
+
+class TTLCache(Generic[V]):
+    """Thread-safe LRU cache whose entries also expire `ttl` seconds after they were stored.
+
+    Sync routes run on the threadpool while async routes run on the event loop, so every
+    operation takes a lock; none of them block on I/O.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 3600.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, Tuple[float, V]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> Optional[V]:
+        with self._lock:
+            hit = self._data.get(key)
+            if hit is None:
+                return None
+            expires, value = hit
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: V) -> V:
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return value
+
+    def pop(self, key: Hashable) -> Optional[V]:
+        with self._lock:
+            hit = self._data.pop(key, None)
+        return hit[1] if hit else None
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class JSONFileCache:
+    """Read-through cache of parsed JSON files.
+
+    Each read costs one stat(): the cached value is served while the file's (inode, mtime, size)
+    is unchanged, so writes from other workers sharing the directory are seen on the next read.
+    Files replaced by rename get a new inode, which tells two writes apart even when they land in
+    the same mtime tick with the same size. Callers get a deep copy and may mutate it freely.
+    """
+
+    def __init__(self, maxsize: int = 4096):
+        self._entries: TTLCache[Tuple[Tuple[int, int, int], Any]] = TTLCache(maxsize=maxsize, ttl=float("inf"))
+
+    @staticmethod
+    def _stamp(p: Path) -> Optional[Tuple[int, int, int]]:
+        try:
+            st = os.stat(p)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def load(self, p: Path, default: Callable[[], Any]) -> Any:
+        stamp = self._stamp(p)
+        if stamp is None:
+            self._entries.pop(p)
+            return default()
+        hit = self._entries.get(p)
+        if hit is None or hit[0] != stamp:
+            hit = self._entries.set(p, (stamp, json.loads(p.read_text())))
+        return copy.deepcopy(hit[1])
+
+    def store(self, p: Path, data: Any):
+        """Record what was just written to `p`, so the next load does not re-read it."""
+        stamp = self._stamp(p)
+        if stamp is None:
+            self._entries.pop(p)
+        else:
+            self._entries.set(p, (stamp, copy.deepcopy(data)))
+
+    def invalidate(self, p: Path):
+        self._entries.pop(p)
@@ -0,0 +1,68 @@
+"""In-process fan-out of per-account events to server-sent-event streams.
+
+Publishers call `publish` from any thread; each subscriber has a bounded queue on its own event
+loop. A subscriber that falls `queue_size` events behind is cut off (it receives None) rather
+than holding memory for a dead connection: audit events carry their byte offset in the audit
+log as id, so the client reconnects with Last-Event-ID and replays what it missed from the log.
+Events of other workers are not seen; the log is what they share.
+"""
+import asyncio, contextlib, threading
+from typing import Dict, Iterator, List, Optional, Tuple
+
+Event = Tuple[Optional[int], str, str]  # (id, event name, JSON data)
+
+
+def sse(event: str, data: str, id: Optional[int] = None) -> str:
+    """One text/event-stream message; `data` must be a single line (compact JSON is)."""
+    head = f"id: {id}\n" if id is not None else ""
+    return f"{head}event: {event}\ndata: {data}\n\n"
+
+
+class Subscriber:
+    def __init__(self, queue_size: int):
+        self.loop = asyncio.get_running_loop()
+        self.queue: "asyncio.Queue[Optional[Event]]" = asyncio.Queue(queue_size)
+
+    def _put(self, item: Event):
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+
+
+class EventBus:
+    def __init__(self, queue_size: int = 1000):
+        self.queue_size = queue_size
+        self._subs: Dict[str, List[Subscriber]] = {}
+        self._lock = threading.Lock()
+
+    def publish(self, email: str, event: str, data: str, id: Optional[int] = None):
+        with self._lock:
+            subs = list(self._subs.get(email, ()))
+        for sub in subs:
+            try:
+                sub.loop.call_soon_threadsafe(sub._put, (id, event, data))
+            except RuntimeError:
+                pass  # its loop has shut down
+
+    def subscribers(self, email: str) -> int:
+        with self._lock:
+            return len(self._subs.get(email, ()))
+
+    @contextlib.contextmanager
+    def subscribe(self, email: str) -> Iterator[Subscriber]:
+        """Register a queue for `email` (call from the consuming event loop) for the duration of the block."""
+        sub = Subscriber(self.queue_size)
+        with self._lock:
+            self._subs.setdefault(email, []).append(sub)
+        try:
+            yield sub
+        finally:
+            with self._lock:
+                subs = self._subs.get(email, [])
+                if sub in subs:
+                    subs.remove(sub)
+                if not subs:
+                    self._subs.pop(email, None)
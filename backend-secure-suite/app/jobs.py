@@ -0,0 +1,288 @@
+"""Persistent background jobs for long-running work such as whole-label classification.
+
+Each job is two files under the jobs directory: `<id>.json` with its state (rewritten
+atomically on every update) and `<id>.ndjson` with its results, appended one page at a time.
+The state records how many result bytes belong to it, so a job interrupted by a restart is
+re-queued, its results are truncated back to the last recorded page, and the handler resumes
+from whatever position it saved.
+
+The files are the only record of a job, so every worker process sharing the directory sees
+every job. A job runs while its runner holds the non-blocking flock on `<id>.lock`; whoever
+fails to take it leaves the job alone, and a runner that dies releases it, so each job runs
+once and an interrupted one is picked up by whichever worker scans for it next. Cancelling a
+job that is running elsewhere drops an `<id>.cancel` marker, which its handler sees.
+"""
+import asyncio, fcntl, json, logging, os, tempfile, time, uuid
+from itertools import islice
+from pathlib import Path
+from typing import IO, Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+log = logging.getLogger("siftmail.jobs")
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+
+def _write_atomic(p: Path, data: dict):
+    fd, tmp = tempfile.mkstemp(dir=p.parent, prefix=p.name, suffix=".tmp")
+    with os.fdopen(fd, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, p)
+
+
+class Job:
+    """Handle passed to a job handler: its parameters, saved state and a way to report progress."""
+
+    def __init__(self, queue: "JobQueue", state: Dict[str, Any]):
+        self._queue = queue
+        self.state = state
+
+    @property
+    def id(self) -> str:
+        return self.state["id"]
+
+    @property
+    def email(self) -> str:
+        return self.state["email"]
+
+    @property
+    def params(self) -> Dict[str, Any]:
+        return self.state["params"]
+
+    @property
+    def cancelled(self) -> bool:
+        if not self.state.get("cancel_requested") and self._queue.cancel_path(self.id).exists():
+            self.state["cancel_requested"] = True  # cancelled from another worker
+        return self.state.get("cancel_requested", False)
+
+    def update(self, results: Optional[List[dict]] = None, **fields):
+        """Append `results` and merge `fields` (e.g. progress, resume position) into the saved state."""
+        if results:
+            with self._queue.results_path(self.id).open("ab") as f:
+                f.write("".join(json.dumps(r) + "\n" for r in results).encode())
+                self.state["results_size"] = f.tell()
+            self.state["result_count"] = self.state.get("result_count", 0) + len(results)
+        self.state.update(fields)
+        self._queue.save(self.state)
+
+
+Handler = Callable[[Job], Awaitable[Optional[Dict[str, Any]]]]
+
+
+class JobQueue:
+    """Runs jobs on `workers` asyncio tasks, at most `per_user` at a time for any one account.
+
+    Both limits are per process. Handlers are registered per job kind. They should check
+    `job.cancelled` between units of work and return normally when it is set; whatever they
+    return is stored as the job's `summary`.
+    """
+
+    def __init__(self, root: Path, workers: int = 4, per_user: int = 1, scan_interval: float = 30.0):
+        self.root = root
+        self.workers = workers
+        self.per_user = per_user
+        self.scan_interval = scan_interval  # how often to look for jobs submitted or orphaned elsewhere
+        self._handlers: Dict[str, Handler] = {}
+        self._pending: List[Tuple[str, str]] = []  # (job id, email)
+        self._active: Set[str] = set()
+        self._running: Dict[str, int] = {}
+        self._cond: Optional[asyncio.Condition] = None
+        self._tasks: List[asyncio.Task] = []
+        self._notifying: Set[asyncio.Task] = set()
+
+    def register(self, kind: str, handler: Handler):
+        self._handlers[kind] = handler
+
+    def state_path(self, job_id: str) -> Path:
+        return self.root / f"{job_id}.json"
+
+    def results_path(self, job_id: str) -> Path:
+        return self.root / f"{job_id}.ndjson"
+
+    def cancel_path(self, job_id: str) -> Path:
+        return self.root / f"{job_id}.cancel"
+
+    def save(self, state: Dict[str, Any]):
+        state["updated"] = int(time.time())
+        _write_atomic(self.state_path(state["id"]), state)
+
+    def _claim(self, job_id: str) -> Optional[IO]:
+        """The job's lock, taken without waiting (None if another runner has it); held until the file is closed."""
+        f = open(self.root / f"{job_id}.lock", "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            return None
+        return f
+
+    def _delete(self, job_id: str):
+        for suffix in (".json", ".ndjson", ".cancel", ".lock"):
+            (self.root / f"{job_id}{suffix}").unlink(missing_ok=True)
+
+    def _states(self) -> List[Dict[str, Any]]:
+        states = []
+        for p in self.root.glob("*.json"):
+            state = self.get(p.stem)
+            if state is not None:
+                states.append(state)
+        return states
+
+    def submit(self, email: str, kind: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        if kind not in self._handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        state = {"id": uuid.uuid4().hex, "email": email, "kind": kind, "params": params, "status": QUEUED,
+                 "created": int(time.time()), "progress": {}, "result_count": 0, "results_size": 0}
+        self.save(state)
+        self._enqueue(state["id"], email)
+        return state
+
+    def _enqueue(self, job_id: str, email: str):
+        self._pending.append((job_id, email))
+        if self._cond is not None:
+            task = asyncio.get_running_loop().create_task(self._notify())
+            self._notifying.add(task)  # the loop only keeps a weak reference
+            task.add_done_callback(self._notifying.discard)
+
+    async def _notify(self):
+        async with self._cond:
+            self._cond.notify_all()
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        if not job_id.isalnum():  # ids come from URLs and name files
+            return None
+        try:
+            state = json.loads(self.state_path(job_id).read_text())
+        except (FileNotFoundError, ValueError):
+            return None
+        if state["status"] not in FINISHED and self.cancel_path(job_id).exists():
+            state["cancel_requested"] = True
+        return state
+
+    def list(self, email: str) -> List[Dict[str, Any]]:
+        return sorted((s for s in self._states() if s["email"] == email), key=lambda s: s["created"], reverse=True)
+
+    def results(self, job_id: str, offset: int = 0, limit: int = 200) -> Tuple[List[dict], Optional[int]]:
+        """A slice of a job's results and the offset of the next one (None once caught up)."""
+        state = self.get(job_id)
+        if state is None:
+            raise KeyError(job_id)
+        p = self.results_path(job_id)
+        if limit <= 0 or not p.exists():
+            return [], None
+        with p.open("rb") as f:
+            items = [json.loads(line) for line in islice(f, offset, offset + limit)]
+        nxt = offset + len(items)
+        return items, nxt if nxt < state.get("result_count", 0) else None
+
+    def cancel(self, job_id: str) -> Dict[str, Any]:
+        if self.get(job_id) is None:
+            raise KeyError(job_id)
+        lock = self._claim(job_id)
+        if lock is None:  # running: seen by the handler between units of work
+            self.cancel_path(job_id).touch()
+            return self.get(job_id)
+        with lock:  # not running anywhere, and nobody can start it while we hold this
+            state = self.get(job_id)
+            if state is None:
+                raise KeyError(job_id)
+            if state["status"] not in FINISHED:
+                state.update(status=CANCELLED, finished=int(time.time()))
+                self.save(state)
+            return state
+
+    def forget(self, email: str):
+        """Cancel every job of an account and delete the ones that are no longer running."""
+        for job_id in [s["id"] for s in self.list(email)]:
+            state = self.cancel(job_id)
+            if state["status"] in FINISHED:
+                self._delete(job_id)
+
+    def prune(self, older_than: float):
+        """Delete finished jobs last updated before `older_than` (epoch seconds)."""
+        for state in self._states():
+            if state["status"] in FINISHED and state.get("updated", state["created"]) < older_than:
+                self._delete(state["id"])
+
+    async def _next(self) -> Tuple[str, str]:
+        async with self._cond:
+            while True:
+                for i, (job_id, email) in enumerate(self._pending):
+                    if self._running.get(email, 0) < self.per_user:
+                        del self._pending[i]
+                        self._running[email] = self._running.get(email, 0) + 1
+                        return job_id, email
+                await self._cond.wait()
+
+    async def _execute(self, job_id: str):
+        lock = self._claim(job_id)
+        if lock is None:
+            return  # another worker is running it
+        with lock:
+            state = self.get(job_id)  # as saved by whoever ran it last
+            if state is None or state["status"] in FINISHED:
+                return
+            job = Job(self, state)
+            if job.cancelled:
+                state.update(status=CANCELLED, finished=int(time.time()))
+                self.save(state)
+                self.cancel_path(job_id).unlink(missing_ok=True)
+                return
+            p = self.results_path(job_id)
+            if p.exists():  # drop a page written after the state last was
+                with p.open("r+b") as f:
+                    f.truncate(state.get("results_size", 0))
+            state.update(status=RUNNING, started=state.get("started") or int(time.time()))
+            self.save(state)
+            try:
+                summary = await self._handlers[state["kind"]](job)
+                state.update(status=CANCELLED if job.cancelled else DONE, summary=summary)
+            except asyncio.CancelledError:
+                raise  # shutting down: leave it "running" so it resumes on the next start
+            except Exception as e:
+                log.warning("job %s failed: %s", job_id, e)
+                state.update(status=FAILED, error=str(e))
+            state["finished"] = int(time.time())
+            self.save(state)
+            self.cancel_path(job_id).unlink(missing_ok=True)
+
+    async def _worker(self):
+        while True:
+            job_id, email = await self._next()
+            self._active.add(job_id)
+            try:
+                await self._execute(job_id)
+            finally:
+                self._active.discard(job_id)
+                self._running[email] -= 1
+                async with self._cond:
+                    self._cond.notify_all()
+
+    async def _scanner(self):
+        """Queue unfinished jobs this process does not know about: submitted elsewhere, or orphaned by a dead worker."""
+        while True:
+            states = await asyncio.to_thread(self._states)
+            known = self._active | {job_id for job_id, _ in self._pending}
+            for state in sorted(states, key=lambda s: s["created"]):
+                if state["status"] in (QUEUED, RUNNING) and state["id"] not in known:
+                    self._enqueue(state["id"], state["email"])
+            await asyncio.sleep(self.scan_interval)
+
+    def start(self):
+        """Start the workers, and a scanner that re-queues unfinished jobs (at once, then every `scan_interval`)."""
+        if self._tasks:
+            return
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._cond = asyncio.Condition()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._scanner()))
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        for t in self._tasks:
+            try:
+                await t
+            except asyncio.CancelledError:
+                pass
+        self._tasks = []
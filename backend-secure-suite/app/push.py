@@ -0,0 +1,91 @@
+"""Gmail push notifications delivered through a Pub/Sub push subscription.
+
+Once `users.watch` is registered, Gmail publishes {"emailAddress", "historyId"} to the topic
+whenever a watched mailbox changes, and the subscription POSTs it to our webhook wrapped in an
+envelope whose `message.data` is base64 JSON. Notifications only say "something changed": each
+sweep replays everything since the account's last checkpoint, so a burst for one account
+collapses into at most one running sweep plus one queued behind it.
+
+Running this module plays the part of Pub/Sub against a local server:
+
+    python -m app.push "http://localhost:8080/gmail/push?token=$GMAIL_PUSH_TOKEN" user@example.com 123456
+"""
+import asyncio, base64, json, logging, sys, uuid
+from typing import Any, Awaitable, Callable, Dict, Set, Tuple
+
+import httpx
+
+log = logging.getLogger("siftmail.push")
+
+
+def decode_push(envelope: Dict[str, Any]) -> Tuple[str, int]:
+    """(emailAddress, historyId) of a push envelope; ValueError when it is not a Gmail notification."""
+    try:
+        data = json.loads(base64.b64decode(envelope["message"]["data"]))
+        return str(data["emailAddress"]), int(data["historyId"])
+    except (KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Not a Gmail push notification: {e!r}") from None
+
+
+def encode_push(email: str, history_id: int, subscription: str = "projects/local/subscriptions/siftmail") -> Dict[str, Any]:
+    """The envelope Pub/Sub would POST for a Gmail notification."""
+    data = json.dumps({"emailAddress": email, "historyId": history_id}).encode()
+    return {"message": {"data": base64.b64encode(data).decode(), "messageId": uuid.uuid4().hex}, "subscription": subscription}
+
+
+class PushDispatcher:
+    """Runs `run(email)` for notified accounts, one at a time per account, coalescing repeats."""
+
+    def __init__(self, run: Callable[[str], Awaitable[object]]):
+        self._run = run
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._again: Set[str] = set()
+        self.metrics = {"notifications": 0, "runs": 0, "coalesced": 0, "failures": 0}
+
+    def notify(self, email: str) -> bool:
+        """Start a run for `email`, or queue one after the current run; False when one is already queued."""
+        self.metrics["notifications"] += 1
+        if email not in self._tasks:
+            self._tasks[email] = asyncio.create_task(self._loop(email))
+            return True
+        if email in self._again:
+            self.metrics["coalesced"] += 1
+            return False
+        self._again.add(email)
+        return True
+
+    async def _loop(self, email: str):
+        try:
+            while True:
+                self._again.discard(email)
+                self.metrics["runs"] += 1
+                try:
+                    await self._run(email)
+                except Exception as e:
+                    self.metrics["failures"] += 1
+                    log.warning("push-triggered run failed for %s: %s", email, e)
+                if email not in self._again:
+                    break
+        finally:
+            self._tasks.pop(email, None)
+
+    def status(self) -> Dict[str, Any]:
+        return {**self.metrics, "running": sorted(self._tasks), "queued": sorted(self._again)}
+
+    async def stop(self):
+        tasks = list(self._tasks.values())
+        for t in tasks:
+            t.cancel()
+        for t in tasks:
+            try:
+                await t
+            except asyncio.CancelledError:
+                pass
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4:
+        sys.exit("usage: python -m app.push <webhook url> <email> <historyId>")
+    url, email, history_id = sys.argv[1:]
+    r = httpx.post(url, json=encode_push(email, int(history_id)))
+    print(r.status_code, r.text)
@@ -0,0 +1,112 @@
+"""Token buckets metered in Gmail quota units, plus retry backoff helpers.
+
+Gmail charges each method a number of quota units and enforces a per-user rate (250 units/s)
+and a per-project one (1,200,000 units/min). Every request takes its units from the user's
+bucket and then the global one, waiting when either is empty, so a busy tenant is slowed down
+here instead of being answered with 429s.
+
+Buckets live in this process: with several server processes each one meters on its own, so
+their configured rates should add up to the real quotas.
+"""
+import asyncio, random, time
+from email.utils import parsedate_to_datetime
+from typing import Dict, Optional
+
+# https://developers.google.com/gmail/api/reference/quota
+QUOTA_UNITS = {
+    "getProfile": 1,
+    "labels.list": 1,
+    "labels.create": 5,
+    "history.list": 2,
+    "messages.list": 5,
+    "messages.get": 5,
+    "messages.modify": 5,
+    "messages.batchModify": 50,
+    "watch": 100,
+    "stop": 50,
+}
+
+
+class TokenBucket:
+    """Holds up to `burst` units, refilled at `rate` units per second; waiters are served in order."""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        self.rate = rate
+        self.burst = burst or rate
+        self._tokens = self.burst
+        self._stamp = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    async def acquire(self, units: float = 1) -> float:
+        """Take `units`, sleeping until they are available; returns the seconds spent waiting.
+
+        A request larger than `burst` goes through once the bucket is full and leaves it in debt,
+        which later requests wait out, so it is still charged in full.
+        """
+        needed = min(units, self.burst)
+        waited = 0.0
+        async with self._lock:
+            self._refill()
+            while self._tokens < needed:
+                delay = (needed - self._tokens) / self.rate
+                await asyncio.sleep(delay)
+                waited += delay
+                self._refill()
+            self._tokens -= units
+        return waited
+
+    def full(self) -> bool:
+        """Refilled to `burst` with nobody waiting: indistinguishable from a new bucket."""
+        return not self._lock.locked() and self._tokens + (time.monotonic() - self._stamp) * self.rate >= self.burst
+
+
+class RateLimiter:
+    """A bucket per user plus one shared by everyone.
+
+    Every `sweep_interval` seconds, user buckets that have refilled are dropped (a new one starts
+    full), so accounts that stopped calling Gmail are not kept forever.
+    """
+
+    def __init__(self, per_user_rate: float = 250.0, global_rate: float = 20000.0, sweep_interval: float = 60.0):
+        self.per_user_rate = per_user_rate
+        self.sweep_interval = sweep_interval
+        self._users: Dict[str, TokenBucket] = {}
+        self._global = TokenBucket(global_rate)
+        self._swept = time.monotonic()
+
+    def _sweep(self):
+        self._swept = time.monotonic()
+        for email in [e for e, b in self._users.items() if b.full()]:
+            del self._users[email]
+
+    async def acquire(self, email: str, units: float) -> float:
+        if time.monotonic() - self._swept >= self.sweep_interval:
+            self._sweep()
+        bucket = self._users.get(email)
+        if bucket is None:
+            bucket = self._users[email] = TokenBucket(self.per_user_rate)
+        return await bucket.acquire(units) + await self._global.acquire(units)
+
+
+def retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds to wait from a Retry-After header (delta-seconds or an HTTP date)."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff(attempt: int, base: float, cap: float) -> float:
+    """Exponential backoff with full jitter for the given (0-based) retry attempt."""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
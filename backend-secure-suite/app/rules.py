@@ -0,0 +1,183 @@
+"""Compiled per-user scoring rules.
+
+A RuleSet is built once from a user's allow/block lists and reused for every message in a
+batch. The allowlist is a set probe over the sender address and its parent domains; the
+subject/sender/snippet heuristics and the user's block entries are keywords of one
+Aho–Corasick automaton (see app/matcher.py), so every hit is found in a single pass and the
+cost stays flat however long the lists grow. `score_batch` scans every record of a batch in
+that one pass, then turns each record's set of hits into a score with a precomputed table.
+"""
+import hashlib, json, re
+from bisect import bisect_right
+from itertools import product
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from .matcher import KeywordMatcher
+
+SUBJECT_TERMS = ["free", "winner", "congratulations", "urgent", "verify", "invoice", "payment", "limited", "act now", "gift", "deal", "promo", "offer"]
+SENDER_TERMS = ["noreply@", "no-reply@", "mailer-daemon"]
+SENDER_TLDS = ["ru", "cn", "tk", "xyz", "top", "icu"]
+SHORTENER_DOMAINS = ["bit.ly", "linktr.ee", "tinyurl.com", "t.co", "kutt.it"]
+
+WEIGHTS = {
+    "blocklist": 0.6,
+    "subject_pattern": 0.3,
+    "sender_pattern": 0.25,
+    "no_unsubscribe": 0.1,
+    "link_shortener": 0.15,
+    "short_snippet": 0.05,
+}
+
+# Folded into every RuleSet.version, so scores cached under older heuristics are never reused.
+HEURISTICS_VERSION = hashlib.sha1(json.dumps([SUBJECT_TERMS, SENDER_TERMS, SENDER_TLDS, SHORTENER_DOMAINS, WEIGHTS]).encode()).hexdigest()[:8]
+
+# Hits are a bitmask over WEIGHTS; OUTCOMES[mask] is (score, reasons), summed in WEIGHTS order.
+_BIT = {reason: 1 << i for i, reason in enumerate(WEIGHTS)}
+
+def _outcome(mask: int) -> Tuple[float, Tuple[str, ...]]:
+    score, reasons = 0.0, []
+    for reason, weight in WEIGHTS.items():
+        if mask & _BIT[reason]:
+            score += weight
+            reasons.append(reason)
+    return round(min(score, 1.0), 2), tuple(reasons)
+
+OUTCOMES = [_outcome(mask) for mask in range(1 << len(WEIGHTS))]
+_ALLOWED = -1
+
+# Each record is laid out as subject\0address\0return-path\0snippet\0. No keyword contains a
+# \0, so every hit lies inside one field; a keyword's payload is (reason bit, fields it counts
+# in as a bitmask, where in the field it has to sit).
+SUBJECT, SENDER, RETURN_PATH, SNIPPET = range(4)
+_ANYWHERE, _AT_END, _DOMAIN, _WHOLE = range(4)
+
+# The heuristics were once case-insensitive regexes, and re.I also equates "İ" and "ı" with "i"
+# and "ſ" with "s". Text is lower-cased with İ folded first, keywords are expanded with the
+# other two, so the automaton finds exactly what those regexes did.
+_FOLD = {0x130: "i"}
+_EQUIVALENTS = {"i": "iı", "s": "sſ"}
+
+def _variants(term: str) -> Iterator[str]:
+    for chars in product(*(_EQUIVALENTS.get(c, c) for c in term.lower())):
+        yield "".join(chars)
+
+def _heuristic_keywords() -> Iterator[Tuple[str, Tuple[int, int, int]]]:
+    sender = 1 << SENDER | 1 << RETURN_PATH
+    for reason, fields, where, terms in [
+        ("subject_pattern", 1 << SUBJECT, _ANYWHERE, SUBJECT_TERMS),
+        ("sender_pattern", sender, _ANYWHERE, SENDER_TERMS),
+        ("sender_pattern", sender, _AT_END, ["." + tld for tld in SENDER_TLDS]),
+        ("link_shortener", 1 << SNIPPET, _ANYWHERE, SHORTENER_DOMAINS),
+    ]:
+        for term in terms:
+            for variant in _variants(term):
+                yield variant, (_BIT[reason], fields, where)
+
+HEURISTIC_KEYWORDS = list(_heuristic_keywords())
+_HEURISTICS = KeywordMatcher(HEURISTIC_KEYWORDS)  # shared by every RuleSet without block entries
+
+def sender_parts(headers: Dict[str, str]) -> Tuple[str, str]:
+    fromv = headers.get("From", "") or ""
+    m = re.search(r"<([^>]+)>", fromv)
+    addr = (m.group(1) if m else fromv).strip().lower()
+    dom = addr.split("@")[-1] if "@" in addr else ""
+    return addr, dom
+
+def domain_suffixes(dom: str) -> Iterator[str]:
+    """mail.news.example.com -> mail.news.example.com, news.example.com, example.com, com"""
+    while dom:
+        yield dom
+        dom = dom.partition(".")[2]
+
+def _field(text: str) -> str:
+    return (text or "").replace("\x00", "")
+
+def _folded(text: str) -> str:
+    return _field(text).translate(_FOLD).lower()
+
+
+class RuleSet:
+    def __init__(self, allow: Iterable[str] = (), block: Iterable[str] = ()):
+        allow = {a.strip().lower() for a in allow or () if a and a.strip()}
+        block = {b.strip().lower() for b in block or () if b and b.strip()}
+        # allow: exact addresses or "@domain"; block additionally accepts a bare "domain"
+        self.allow_addrs = {a for a in allow if not a.startswith("@")}
+        self.allow_domains = {a[1:] for a in allow if a.startswith("@")}
+        self.block_addrs = {b for b in block if "@" in b and not b.startswith("@")}
+        self.block_domains = {b.lstrip("@") for b in block if "@" not in b or b.startswith("@")}
+        self.version = hashlib.sha1(json.dumps([HEURISTICS_VERSION, sorted(allow), sorted(block)]).encode()).hexdigest()[:16]
+        # block entries join the heuristics in the automaton, matched against the sender address:
+        # an address must fill it, a domain must end it right after the "@" or a "."
+        listed = _BIT["blocklist"], 1 << SENDER
+        blocks = [(b, (*listed, _WHOLE)) for b in self.block_addrs if "\x00" not in b]
+        blocks += [(d, (*listed, _DOMAIN)) for d in self.block_domains if "@" not in d and "\x00" not in d]
+        self.matcher = KeywordMatcher(HEURISTIC_KEYWORDS + blocks) if blocks else _HEURISTICS
+
+    @classmethod
+    def from_rules(cls, rules: Dict[str, Any]) -> "RuleSet":
+        return cls(rules.get("allow") or [], rules.get("block") or [])
+
+    def allowed(self, addr: str, dom: str) -> bool:
+        return addr in self.allow_addrs or any(d in self.allow_domains for d in domain_suffixes(dom))
+
+    def score(self, headers: Dict[str, str], snippet: str = "") -> Dict[str, Any]:
+        scores, reasons = self.score_batch([(headers, snippet)])
+        return {"score": scores[0], "reasons": reasons[0]}
+
+    def score_batch(self, records: Iterable[Tuple[Dict[str, str], Optional[str]]]) -> Tuple[List[float], List[List[str]]]:
+        """Score (headers, snippet) records together: parallel lists of scores and reasons.
+
+        Results are identical to calling `score` on each record. The fields of every record
+        are concatenated and scanned by the automaton once; `bounds` holds where each field
+        starts, so a hit's field (and with it the record) is one bisect away.
+        """
+        masks: List[int] = []
+        texts: List[str] = []
+        bounds: List[int] = []
+        owners: List[int] = []
+        senders: Dict[str, Tuple[str, bool]] = {}  # From header -> (address, allowlisted); archives repeat senders a lot
+        pos = 0
+        for i, (headers, snippet) in enumerate(records):
+            snippet = snippet or ""
+            fromv = headers.get("From") or ""
+            sender = senders.get(fromv)
+            if sender is None:
+                addr, dom = sender_parts(headers)
+                sender = senders[fromv] = (_field(addr), self.allowed(addr, dom))
+            addr, allowed = sender
+            if allowed:
+                masks.append(_ALLOWED)
+                continue
+            mask = 0
+            if "List-Unsubscribe" not in headers:
+                mask |= _BIT["no_unsubscribe"]
+            if snippet and len(snippet) < 20:
+                mask |= _BIT["short_snippet"]
+            masks.append(mask)
+            owners.append(i)
+            for field in (_folded(headers.get("Subject")), addr, _folded(headers.get("Return-Path")), _folded(snippet)):
+                texts.append(field)
+                bounds.append(pos)
+                pos += len(field) + 1
+
+        text = "\x00".join(texts) + "\x00"
+        for start, end, (bit, fields, where) in self.matcher.finditer(text):
+            k = bisect_right(bounds, start) - 1
+            if not fields & 1 << (k & 3):
+                continue
+            if where != _ANYWHERE and (text[end] != "\x00"
+                                       or where == _WHOLE and start != bounds[k]
+                                       or where == _DOMAIN and (text[start - 1] not in "@." or text.find("@", bounds[k], start) < 0)):
+                continue
+            masks[owners[k >> 2]] |= bit
+
+        scores, reasons = [], []
+        for mask in masks:
+            if mask == _ALLOWED:
+                scores.append(0.0)
+                reasons.append(["allowlist"])
+            else:
+                score, why = OUTCOMES[mask]
+                scores.append(score)
+                reasons.append(list(why))
+        return scores, reasons
@@ -0,0 +1,348 @@
+"""Per-account state: OAuth tokens, settings, rules, sync checkpoints and the audit log.
+
+Two interchangeable stores sit behind the `load_*`/`save_*` helpers of main.py:
+
+- `FileStore`, the original layout: one JSON file per account and kind under TOKEN_STORE and
+  DATA_DIR, and one JSONL audit log per account (see app/audit.py). Files are replaced by
+  rename, never rewritten in place, and `update` holds an advisory lock on the document.
+- `SQLiteStore`, a single database in WAL mode for every account: documents in one table, audit
+  entries in another. Readers never wait for the writer, a rule edit commits together with its
+  audit entry, and thousands of accounts do not mean thousands of files per directory.
+
+Documents are JSON objects; `stamp` changes whenever one is saved, so callers can cache what they
+derive from it. Every audit entry has an id that grows with each entry appended (a byte offset
+in a log file, a row id in the database): pages are read backwards from a cursor and event
+streams resume after an id.
+
+Moving an existing deployment into a database (safe to re-run; it replaces what it copies):
+
+    python -m app.store --tokens ./tokens --data ./data --db ./data/state.sqlite3
+"""
+import argparse, contextlib, fcntl, json, os, queue, sqlite3, tempfile, threading, time
+from pathlib import Path
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
+
+from . import audit as audit_log
+from .cache import JSONFileCache
+
+KINDS = ("tokens", "settings", "rules", "sync")
+
+Written = List[Tuple[int, str]]  # (id, JSON line) of each audit entry just stored
+
+
+def user_key(email: str) -> str:
+    return email.replace("/", "_")
+
+
+def write_json_atomic(p: Path, data: dict):
+    fd, tmp = tempfile.mkstemp(dir=p.parent, prefix=p.name, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(json.dumps(data, indent=2))
+        os.replace(tmp, p)
+    except BaseException:
+        Path(tmp).unlink(missing_ok=True)
+        raise
+
+
+def _none() -> None:
+    return None
+
+
+class FileStore:
+    """JSON files under `token_dir` (tokens) and `data_dir/<kind>`; audit logs under `data_dir/logs`.
+
+    Readers never see a partly written document: each save writes a temporary file and renames it
+    over the old one. `update` takes an exclusive flock() on `<document>.lock` for its whole
+    read-modify-write, which serializes it with updates of the same document from other threads
+    and other worker processes on the host, and with nothing else. Lock files are left in place:
+    removing one while another worker waits on it would let a third lock a new file.
+    """
+
+    def __init__(self, token_dir: Path, data_dir: Path):
+        self._dirs = {"tokens": token_dir, "settings": data_dir / "settings", "rules": data_dir / "rules", "sync": data_dir / "sync"}
+        self._logs = data_dir / "logs"
+        for d in [*self._dirs.values(), self._logs]:
+            d.mkdir(parents=True, exist_ok=True)
+        # a read costs one stat() unless the file changed since it was last loaded or saved
+        self._cache = JSONFileCache()
+
+    def path(self, kind: str, email: str) -> Path:
+        return self._dirs[kind] / f"{user_key(email)}.json"
+
+    def audit_path(self, email: str) -> Path:
+        return self._logs / f"{user_key(email)}.jsonl"
+
+    def load(self, kind: str, email: str, default: Callable[[], Any] = _none) -> Any:
+        return self._cache.load(self.path(kind, email), default)
+
+    def save(self, kind: str, email: str, data: dict):
+        p = self.path(kind, email)
+        write_json_atomic(p, data)
+        self._cache.store(p, data)
+
+    @contextlib.contextmanager
+    def _locked(self, p: Path) -> Iterator[None]:
+        with open(f"{p}.lock", "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)  # released when the file is closed
+            yield
+
+    def update(self, kind: str, email: str, fn: Callable[[dict], Any], default: Callable[[], dict],
+               entry: Optional[dict] = None) -> Tuple[dict, Written]:
+        """Load a document (or `default()`), let `fn` change it in place, save it and log `entry`, under its lock."""
+        p = self.path(kind, email)
+        with self._locked(p):
+            try:
+                data = json.loads(p.read_text())  # not the cache: the file may have been replaced within its mtime tick
+            except FileNotFoundError:
+                data = default()
+            fn(data)
+            self.save(kind, email, data)
+            # still locked, so entries are logged in the order the updates were applied
+            return data, self.append_audit(email, [json.dumps(entry) + "\n"]) if entry is not None else []
+
+    def delete(self, kind: str, email: str):
+        p = self.path(kind, email)
+        p.unlink(missing_ok=True)
+        self._cache.invalidate(p)
+
+    def stamp(self, kind: str, email: str) -> Optional[Hashable]:
+        """The document's (inode, mtime, size); None when there is none."""
+        try:
+            st = self.path(kind, email).stat()
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def users(self, kind: str) -> List[str]:
+        return sorted(p.stem for p in self._dirs[kind].glob("*.json"))
+
+    def accounts(self) -> List[str]:
+        return self.users("tokens")
+
+    def append_audit(self, email: str, lines: List[str]) -> Written:
+        return audit_log.append_lines(self.audit_path(email), lines)
+
+    def audit_page(self, email: str, limit: int = 200, cursor: Optional[int] = None, events: Optional[Iterable[str]] = None,
+                   since: Optional[int] = None, until: Optional[int] = None) -> Tuple[List[dict], Optional[int]]:
+        return audit_log.read_page(self.audit_path(email), limit=limit, cursor=cursor, events=events, since=since, until=until)
+
+    def audit_after(self, email: str, after: int) -> Written:
+        return audit_log.read_after(self.audit_path(email), after)
+
+    def audit_users(self) -> List[str]:
+        return sorted(p.stem for p in self._logs.glob("*.jsonl"))
+
+    def delete_audit(self, email: str):
+        self.audit_path(email).unlink(missing_ok=True)
+
+    def close(self):
+        pass
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS docs (
+    kind TEXT NOT NULL,
+    user TEXT NOT NULL,
+    data TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    updated INTEGER NOT NULL,
+    PRIMARY KEY (kind, user)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS audit (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    user TEXT NOT NULL,
+    ts INTEGER NOT NULL,
+    event TEXT,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS audit_user ON audit (user, seq);
+CREATE INDEX IF NOT EXISTS audit_event ON audit (user, event, seq);
+"""
+
+
+class SQLiteStore:
+    """Every account in one SQLite database, through a pool of at most `pool_size` connections.
+
+    Each write is one transaction, begun IMMEDIATE so that `update` reads, changes and writes a
+    document without another writer slipping in between, from this process or any other.
+    """
+
+    def __init__(self, path: Path, pool_size: int = 8, timeout: float = 30.0):
+        self.path = path
+        self.timeout = timeout
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._opened: List[sqlite3.Connection] = []
+        self._lock = threading.Lock()
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with self._conn() as db:
+            db.executescript(SCHEMA)
+
+    def _connect(self) -> sqlite3.Connection:
+        db = sqlite3.connect(str(self.path), timeout=self.timeout, check_same_thread=False, isolation_level=None)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        with self._lock:
+            self._opened.append(db)
+        return db
+
+    @contextlib.contextmanager
+    def _conn(self) -> Iterator[sqlite3.Connection]:
+        """A connection of our own for the duration of the block; waits while all are in use."""
+        with self._slots:
+            try:
+                db = self._idle.get_nowait()
+            except queue.Empty:
+                db = self._connect()
+            try:
+                yield db
+            finally:
+                self._idle.put(db)
+
+    @contextlib.contextmanager
+    def _write(self) -> Iterator[sqlite3.Connection]:
+        with self._conn() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                yield db
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    @staticmethod
+    def _get(db: sqlite3.Connection, kind: str, email: str) -> Optional[dict]:
+        row = db.execute("SELECT data FROM docs WHERE kind = ? AND user = ?", (kind, email)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @staticmethod
+    def _put(db: sqlite3.Connection, kind: str, email: str, data: dict):
+        db.execute("INSERT INTO docs VALUES (?, ?, ?, 1, ?) ON CONFLICT (kind, user) "
+                   "DO UPDATE SET data = excluded.data, version = version + 1, updated = excluded.updated",
+                   (kind, email, json.dumps(data), time.time_ns()))
+
+    @staticmethod
+    def _append(db: sqlite3.Connection, email: str, lines: List[str]) -> Written:
+        written = []
+        for line in lines:
+            line = line.rstrip("\n")
+            entry = json.loads(line)
+            cur = db.execute("INSERT INTO audit (user, ts, event, data) VALUES (?, ?, ?, ?)",
+                             (email, int(entry.get("ts", 0)), entry.get("event"), line))
+            written.append((cur.lastrowid, line))
+        return written
+
+    def load(self, kind: str, email: str, default: Callable[[], Any] = _none) -> Any:
+        with self._conn() as db:
+            data = self._get(db, kind, email)
+        return default() if data is None else data
+
+    def save(self, kind: str, email: str, data: dict):
+        with self._write() as db:
+            self._put(db, kind, email, data)
+
+    def update(self, kind: str, email: str, fn: Callable[[dict], Any], default: Callable[[], dict],
+               entry: Optional[dict] = None) -> Tuple[dict, Written]:
+        """Load a document (or `default()`), let `fn` change it in place, save it and log `entry`, atomically."""
+        with self._write() as db:
+            data = self._get(db, kind, email)
+            if data is None:
+                data = default()
+            fn(data)
+            self._put(db, kind, email, data)
+            written = self._append(db, email, [json.dumps(entry)]) if entry is not None else []
+        return data, written
+
+    def delete(self, kind: str, email: str):
+        with self._write() as db:
+            db.execute("DELETE FROM docs WHERE kind = ? AND user = ?", (kind, email))
+
+    def stamp(self, kind: str, email: str) -> Optional[Hashable]:
+        """The document's (version, time of the last save); None when there is none."""
+        with self._conn() as db:
+            return db.execute("SELECT version, updated FROM docs WHERE kind = ? AND user = ?", (kind, email)).fetchone()
+
+    def users(self, kind: str) -> List[str]:
+        with self._conn() as db:
+            return [u for u, in db.execute("SELECT user FROM docs WHERE kind = ? ORDER BY user", (kind,))]
+
+    def accounts(self) -> List[str]:
+        return self.users("tokens")
+
+    def append_audit(self, email: str, lines: List[str]) -> Written:
+        with self._write() as db:
+            return self._append(db, email, lines)
+
+    def audit_page(self, email: str, limit: int = 200, cursor: Optional[int] = None, events: Optional[Iterable[str]] = None,
+                   since: Optional[int] = None, until: Optional[int] = None) -> Tuple[List[dict], Optional[int]]:
+        """Same contract as audit.read_page, with row ids as cursors."""
+        if limit <= 0:
+            return [], None
+        where, args = ["user = ?"], [email]
+        if cursor is not None:
+            where.append("seq < ?")
+            args.append(cursor)
+        if events:
+            events = list(events)
+            where.append(f"event IN ({','.join('?' * len(events))})")
+            args += events
+        if since is not None:
+            where.append("ts >= ?")
+            args.append(since)
+        if until is not None:
+            where.append("ts <= ?")
+            args.append(until)
+        with self._conn() as db:
+            rows = db.execute(f"SELECT seq, data FROM audit WHERE {' AND '.join(where)} ORDER BY seq DESC LIMIT ?",
+                              (*args, min(limit, 2**63 - 1))).fetchall()
+        next_cursor = rows[-1][0] if len(rows) == limit else None
+        return [json.loads(data) for _, data in reversed(rows)], next_cursor
+
+    def audit_after(self, email: str, after: int) -> Written:
+        with self._conn() as db:
+            return db.execute("SELECT seq, data FROM audit WHERE user = ? AND seq > ? ORDER BY seq", (email, after)).fetchall()
+
+    def audit_users(self) -> List[str]:
+        with self._conn() as db:
+            return [u for u, in db.execute("SELECT DISTINCT user FROM audit ORDER BY user")]
+
+    def delete_audit(self, email: str):
+        with self._write() as db:
+            db.execute("DELETE FROM audit WHERE user = ?", (email,))
+
+    def close(self):
+        with self._lock:
+            opened, self._opened = self._opened, []
+        for db in opened:
+            db.close()
+        self._idle = queue.LifoQueue()
+
+
+def migrate(src: FileStore, dst: SQLiteStore) -> Dict[str, int]:
+    """Copy every document and audit log of `src` into `dst`, replacing what `dst` holds for those accounts."""
+    counts = {kind: 0 for kind in KINDS}
+    for kind in KINDS:
+        for email in src.users(kind):
+            dst.save(kind, email, src.load(kind, email))
+            counts[kind] += 1
+    counts["audit"] = 0
+    for email in src.audit_users():
+        lines = [line for _, line in src.audit_after(email, 0)]
+        with dst._write() as db:  # an account's log is replaced in one transaction
+            db.execute("DELETE FROM audit WHERE user = ?", (email,))
+            dst._append(db, email, lines)
+        counts["audit"] += len(lines)
+    return counts
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Copy file-based account state (tokens, settings, rules, sync, audit logs) into a SQLite state store.")
+    ap.add_argument("--tokens", type=Path, default=Path(os.getenv("TOKEN_STORE", "./tokens")))
+    ap.add_argument("--data", type=Path, default=Path(os.getenv("DATA_DIR", "./data")))
+    ap.add_argument("--db", type=Path, default=None, help="default: STATE_DB, else <data>/state.sqlite3")
+    args = ap.parse_args()
+    db_path = args.db or Path(os.getenv("STATE_DB", str(args.data / "state.sqlite3")))
+    dst = SQLiteStore(db_path)
+    print(json.dumps(migrate(FileStore(args.tokens, args.data), dst)))
+    dst.close()
@@ -0,0 +1,104 @@
+"""OAuth token lifecycle: expiry bookkeeping, persisted refreshes and a background refresher."""
+import asyncio, logging, time
+from typing import Callable, Dict, Iterable, Optional
+
+import httpx
+
+from .scheduler import LeaderLock
+
+log = logging.getLogger("siftmail.tokens")
+
+
+def with_expiry(tokens: dict, now: Optional[float] = None) -> dict:
+    """Stamp a token-endpoint response with an absolute `expires_at` (epoch seconds)."""
+    if "expires_in" in tokens:
+        tokens["expires_at"] = int((now or time.time()) + int(tokens["expires_in"]))
+    return tokens
+
+
+class TokenManager:
+    """Refreshes access tokens against the OAuth token endpoint and writes them back with `save`.
+
+    Request handlers call `refresh` only when a token is already expired or rejected; the
+    background loop started with `start()` refreshes every account `margin` seconds before
+    expiry so that normally never happens. Given a `leader` lock, only the process holding it
+    runs that loop's sweeps. `load`, `save` and `accounts` touch the state store and run in a thread.
+    """
+
+    def __init__(self, load: Callable[[str], dict], save: Callable[[str, dict], None], accounts: Callable[[], Iterable[str]],
+                 client_id: str, client_secret: str, token_url: str, margin: int = 300, interval: int = 60,
+                 leader: Optional[LeaderLock] = None):
+        self._load = load
+        self._save = save
+        self._accounts = accounts
+        self._client_id = client_id
+        self._client_secret = client_secret
+        self._token_url = token_url
+        self._leader = leader
+        self.margin = margin
+        self.interval = interval
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._refreshed: Dict[str, float] = {}
+        self._task: Optional[asyncio.Task] = None
+
+    def expiring(self, expires_at: Optional[float]) -> bool:
+        return expires_at is not None and expires_at - self.margin <= time.time()
+
+    async def refresh(self, email: str, force: bool = True) -> str:
+        """Refresh and persist the user's access token; concurrent callers share one refresh.
+
+        With `force=False` a token that another request or worker already refreshed is reused.
+        """
+        requested = time.monotonic()
+        lock = self._locks.setdefault(email, asyncio.Lock())
+        async with lock:
+            data = await asyncio.to_thread(self._load, email)
+            if self._refreshed.get(email, 0) > requested:
+                return data["access_token"]
+            if not force and data.get("access_token") and not self.expiring(data.get("expires_at", 0)):
+                return data["access_token"]
+            if not data.get("refresh_token"):
+                raise RuntimeError("No refresh token for user; reconnect the account")
+            async with httpx.AsyncClient(timeout=20.0) as client:
+                r = await client.post(self._token_url, data={
+                    "grant_type": "refresh_token",
+                    "refresh_token": data["refresh_token"],
+                    "client_id": self._client_id,
+                    "client_secret": self._client_secret,
+                }, headers={"Content-Type": "application/x-www-form-urlencoded"})
+            if r.status_code != 200:
+                raise RuntimeError(f"Token refresh failed ({r.status_code}): {r.text}")
+            data.update(with_expiry(r.json()))
+            await asyncio.to_thread(self._save, email, data)
+            self._refreshed[email] = time.monotonic()
+            return data["access_token"]
+
+    async def refresh_due(self):
+        """One sweep of the background loop: refresh every account close to (or missing) expiry."""
+        if self._leader is not None and not self._leader.held():
+            return
+        for email in await asyncio.to_thread(lambda: list(self._accounts())):
+            try:
+                data = await asyncio.to_thread(self._load, email)
+                if data.get("refresh_token") and self.expiring(data.get("expires_at", 0)):
+                    await self.refresh(email, force=False)
+            except Exception as e:
+                log.warning("background token refresh failed for %s: %s", email, e)
+
+    async def _run(self):
+        while True:
+            await self.refresh_due()
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
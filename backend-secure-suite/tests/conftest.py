@@ -0,0 +1,96 @@
+import json
+import os
+import re
+import tempfile
+import uuid
+
+import httpx
+import pytest
+
+# app.main reads its configuration at import time
+_DATA = tempfile.mkdtemp(prefix="siftmail-test-")
+os.environ.update(API_KEY="test-key", TOKEN_STORE=os.path.join(_DATA, "tokens"), DATA_DIR=os.path.join(_DATA, "data"))
+
+from fastapi.testclient import TestClient  # noqa: E402
+
+from app import main  # noqa: E402
+
+HEADERS = {"X-API-Key": "test-key"}
+
+
+class FakeGmail:
+    """An in-memory mailbox behind httpx.MockTransport: messages, a history log and the batch endpoint."""
+
+    def __init__(self):
+        self.messages = {}
+        self.labels = [{"id": "INBOX", "name": "INBOX"}]
+        self.history = []  # (historyId, message id) per added message
+        self.history_id = 100
+        self.fail_ids = set()  # metadata batches containing one of these answer 500 as a whole
+
+    def add(self, msg_id, sender, subject, snippet=""):
+        self.history_id += 1
+        self.messages[msg_id] = {"id": msg_id, "snippet": snippet, "labelIds": ["INBOX"], "internalDate": str(1700000000000 + self.history_id),
+                                 "payload": {"headers": [{"name": "From", "value": sender}, {"name": "Subject", "value": subject}]}}
+        self.history.append((self.history_id, msg_id))
+
+    def _batch(self, req):
+        parts = re.findall(r"Content-ID: <(\w+)>.*?GET /gmail/v1/users/me/messages/(\w+)\?", req.content.decode(), re.S)
+        if any(mid in self.fail_ids for _, mid in parts):
+            return httpx.Response(500, json={"error": "backend"})
+        out = []
+        for cid, mid in parts:
+            status, body = ("200 OK", json.dumps(self.messages[mid])) if mid in self.messages else ("404 Not Found", '{"error": "not found"}')
+            out.append(f"--rb\r\nContent-Type: application/http\r\nContent-ID: <response-{cid}>\r\n\r\nHTTP/1.1 {status}\r\nContent-Type: application/json\r\n\r\n{body}\r\n")
+        return httpx.Response(200, headers={"content-type": "multipart/mixed; boundary=rb"}, content="".join(out) + "--rb--\r\n")
+
+    def handler(self, req: httpx.Request):
+        path = req.url.path
+        if path.endswith("/batch/gmail/v1"):
+            return self._batch(req)
+        if path.endswith("/profile"):
+            return httpx.Response(200, json={"emailAddress": "user@example.com", "historyId": str(self.history_id)})
+        if path.endswith("/history"):
+            start = int(req.url.params["startHistoryId"])
+            added = [{"messagesAdded": [{"message": {"id": mid, "labelIds": ["INBOX"]}}]} for hid, mid in self.history if hid > start]
+            return httpx.Response(200, json={"history": added, "historyId": str(self.history_id)})
+        if path.endswith("/messages") and req.method == "GET":
+            newest = [{"id": mid} for _, mid in reversed(self.history)][: int(req.url.params.get("maxResults", 100))]
+            return httpx.Response(200, json={"messages": newest, "resultSizeEstimate": len(newest)})
+        if path.endswith("/labels"):
+            if req.method == "POST":
+                self.labels.append({"id": f"Label_{len(self.labels)}", "name": json.loads(req.content)["name"]})
+                return httpx.Response(200, json=self.labels[-1])
+            return httpx.Response(200, json={"labels": self.labels})
+        if path.endswith("/batchModify"):
+            return httpx.Response(204)
+        m = re.search(r"/messages/(\w+)(/modify)?$", path)
+        if m and m.group(1) in self.messages:
+            return httpx.Response(200, json=self.messages[m.group(1)])
+        return httpx.Response(404, json={"error": f"unhandled {path}"})
+
+
+@pytest.fixture
+def gmail():
+    fake = FakeGmail()
+
+    async def token(email, force=False):
+        return "token"
+
+    main.gmail._token_provider = token
+    main.gmail._http = httpx.AsyncClient(transport=httpx.MockTransport(fake.handler))
+    return fake
+
+
+@pytest.fixture
+def client():
+    return TestClient(main.app)
+
+
+@pytest.fixture
+def account(gmail):
+    """A connected account with no sync state, out of shadow mode."""
+    email = f"user-{uuid.uuid4().hex[:8]}@example.com"
+    main.save_tokens(email, {"access_token": "a", "refresh_token": "r"})
+    main.store.save("settings", email, {"shadow": False})
+    return email
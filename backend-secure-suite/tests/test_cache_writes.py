@@ -0,0 +1,27 @@
+import sqlite3
+
+from app import main
+from conftest import HEADERS
+
+SPAM = ("Promo <deals@spam.xyz>", "FREE offer", "Claim your free gift at bit.ly/x")
+
+
+def locked(*args):
+    raise sqlite3.OperationalError("database is locked")
+
+
+def test_failed_cache_writes_do_not_fail_classification(client, gmail, account, monkeypatch):
+    monkeypatch.setattr(main.score_cache, "store_metadata", locked)
+    monkeypatch.setattr(main.score_cache, "store_scores", locked)
+    gmail.add("m1", *SPAM)
+    r = client.post("/gmail/batch-classify", json={"email": account}, headers=HEADERS)
+    assert r.status_code == 200
+    assert [i["id"] for i in r.json()["items"]] == ["m1"]
+
+
+def test_a_move_that_went_through_is_reported_as_done(client, gmail, account, monkeypatch):
+    gmail.add("m1", *SPAM)
+    monkeypatch.setattr(main.score_cache, "mark_quarantined", locked)
+    r = client.post("/gmail/quarantine", json={"email": account, "message_id": "m1"}, headers=HEADERS)
+    assert r.status_code == 200
+    assert r.json()["action"] == "quarantine"
@@ -0,0 +1,47 @@
+import asyncio
+import fcntl
+
+import pytest
+
+from app import main
+from conftest import HEADERS
+
+SPAM = ("Promo <deals@spam.xyz>", "FREE offer", "Claim your free gift at bit.ly/x")
+
+
+def sweep(email):
+    return asyncio.run(main.batch_classify(email, "INBOX", 50, dry_run=False, incremental=True))
+
+
+def test_dry_run_leaves_the_checkpoint_alone(client, gmail, account):
+    gmail.add("m1", *SPAM)
+    sweep(account)
+    gmail.add("m2", *SPAM)
+    preview = client.post("/gmail/batch-classify", json={"email": account, "incremental": True, "dry_run": True}, headers=HEADERS).json()
+    assert [i["id"] for i in preview["items"]] == ["m2"]
+    assert [i["id"] for i in sweep(account)["items"]] == ["m2"]
+
+
+def test_legacy_checkpoint_is_read_by_the_sweep(gmail, account):
+    gmail.add("m1", *SPAM)
+    main.store.save("sync", account, {"INBOX": str(gmail.history_id)})
+    gmail.add("m2", *SPAM)
+    assert [i["id"] for i in sweep(account)["items"]] == ["m2"]
+
+
+def test_checkpoint_never_moves_backwards(account):
+    asyncio.run(main.commit_checkpoint(account, "sweep", "INBOX", "200"))
+    asyncio.run(main.commit_checkpoint(account, "sweep", "INBOX", "150"))
+    assert main.load_checkpoint(account, "sweep", "INBOX") == "200"
+
+
+def test_sweep_waits_for_another_process(gmail, account):
+    gmail.add("m1", *SPAM)
+    main.SWEEP_LOCK_DIR.mkdir(exist_ok=True)
+    with open(main.SWEEP_LOCK_DIR / f"{main.user_key(account)}.lock", "a") as other_process:
+        fcntl.flock(other_process, fcntl.LOCK_EX)
+        with pytest.raises(asyncio.TimeoutError):
+            asyncio.run(asyncio.wait_for(main.sweep_account(account), 1.0))
+    assert main.load_checkpoint(account, "sweep", "INBOX") is None
+    asyncio.run(main.sweep_account(account))
+    assert main.load_checkpoint(account, "sweep", "INBOX") == str(gmail.history_id)
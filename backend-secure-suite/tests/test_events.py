@@ -0,0 +1,23 @@
+import asyncio
+
+from app import main
+
+SPAM = ("Promo <deals@spam.xyz>", "FREE offer", "Claim your free gift at bit.ly/x")
+
+
+def test_sweeps_that_find_nothing_publish_no_results(gmail, account):
+    gmail.add("m1", *SPAM)
+
+    async def run():
+        with main.event_bus.subscribe(account) as sub:
+            await main.sweep_account(account)
+            await main.sweep_account(account)  # nothing new
+            await asyncio.sleep(0)
+            events = []
+            while not sub.queue.empty():
+                events.append(sub.queue.get_nowait())
+        return [(event, data) for _, event, data in events if event == "classified"]
+
+    classified = asyncio.run(run())
+    assert len(classified) == 1
+    assert '"m1"' in classified[0][1]
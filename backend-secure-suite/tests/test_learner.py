@@ -0,0 +1,23 @@
+import fcntl
+import threading
+
+from app.learner import OnlineLearner
+
+SPAM = {"From": "Promo <deals@spam.xyz>", "Subject": "FREE offer"}
+
+
+def test_a_step_waiting_on_another_worker_blocks_no_reads(tmp_path):
+    learner = OnlineLearner(tmp_path, lambda email: email.split("@")[0])
+    learner.learn("a@example.com", [SPAM], 1)
+    with open(tmp_path / "a.lock", "a") as other_worker:
+        fcntl.flock(other_worker, fcntl.LOCK_EX)
+        step = threading.Thread(target=learner.learn, args=("a@example.com", [SPAM], 1))
+        step.start()
+        step.join(0.2)
+        assert step.is_alive()  # waiting on the flock
+        assert learner.steps("b@example.com") == 0
+        assert learner.steps("a@example.com") == 1
+        assert learner.predict_batch("a@example.com", [SPAM])[0] > 0.5
+    step.join(5)
+    assert not step.is_alive()
+    assert learner.steps("a@example.com") == 2
@@ -0,0 +1,24 @@
+import asyncio
+import fcntl
+import time
+
+from app.scheduler import LeaderLock
+from app.tokens import TokenManager
+
+
+def test_background_refresh_runs_only_on_the_leader(tmp_path):
+    loaded = []
+
+    def load(email):
+        loaded.append(email)
+        return {"access_token": "a", "expires_at": time.time() + 3600}
+
+    leader = LeaderLock(tmp_path / "scheduler.lock")
+    tokens = TokenManager(load, lambda email, data: None, lambda: ["a@example.com"], "id", "secret", "http://token.invalid", leader=leader)
+    with open(tmp_path / "scheduler.lock", "a") as other_process:
+        fcntl.flock(other_process, fcntl.LOCK_EX)
+        asyncio.run(tokens.refresh_due())
+        assert loaded == []
+    asyncio.run(tokens.refresh_due())
+    assert loaded == ["a@example.com"]
+    leader.release()
@@ -8,17 +8,49 @@ export default async function handler(req, res) {
   const headers = { ...req.headers, 'x-api-key': API_KEY, 'content-type': req.headers['content-type'] || 'application/json' };
   delete headers.host;
 
+  const upstream = new AbortController();
+  // the response closes when the browser goes away (req has already ended once the body was parsed);
+  // an event stream would otherwise outlive the tab
+  res.on('close', () => upstream.abort());
+  const gone = () => res.writableEnded || res.destroyed;
   const init = {
     method: req.method,
     headers,
+    signal: upstream.signal,
     body: ['GET','HEAD'].includes(req.method) ? undefined : (typeof req.body === 'string' ? req.body : JSON.stringify(req.body || {})),
   };
 
   try{
     const r = await fetch(url, init);
+    if ((r.headers.get('content-type') || '').startsWith('application/x-ndjson')) {
+      // pass streamed results through line by line instead of buffering the whole body
+      res.status(r.status);
+      res.setHeader('content-type', 'application/x-ndjson');
+      for await (const chunk of r.body) {
+        if (gone()) break;
+        res.write(chunk);
+      }
+      return gone() || res.end();
+    }
+    if ((r.headers.get('content-type') || '').startsWith('text/event-stream')) {
+      res.status(r.status);
+      res.setHeader('content-type', 'text/event-stream');
+      res.setHeader('cache-control', 'no-cache');
+      res.flushHeaders();
+      try {
+        for await (const chunk of r.body) {
+          if (gone()) break;
+          res.write(chunk);
+        }
+      } catch (e) {
+        // aborted when the client went away
+      }
+      return gone() || res.end();
+    }
     const text = await r.text();
     res.status(r.status).send(text);
   }catch(e){
+    if (upstream.signal.aborted || gone()) return;
     res.status(500).json({ error: 'proxy_error', detail: String(e) });
   }
 }
@@ -1,17 +1,27 @@
 
-import { useState } from 'react';
+import { useEffect, useState } from 'react';
 import Layout from '@/components/Layout';
 import { apiGet } from '@/components/useApi';
 
 export default function Audit(){
   const [email, setEmail] = useState('');
   const [items, setItems] = useState([]);
+  const [live, setLive] = useState('');
 
   async function load(){
     const r = await apiGet(`audit?email=${encodeURIComponent(email)}&limit=200`);
     setItems(r.items || []);
+    setLive(email);
   }
 
+  useEffect(()=>{
+    // new entries as they are logged; EventSource reconnects with Last-Event-ID by itself
+    if (!live) return;
+    const es = new EventSource(`/api/sift/events?email=${encodeURIComponent(live)}`);
+    es.addEventListener('audit', e=>setItems(prev=>[...prev, JSON.parse(e.data)]));
+    return ()=>es.close();
+  }, [live]);
+
   return (
     <Layout>
       <section className="container" style={{padding:'36px 0'}}>
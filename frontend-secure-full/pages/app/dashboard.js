@@ -1,5 +1,5 @@
 
-import { useState } from 'react';
+import { useEffect, useState } from 'react';
 import Layout from '@/components/Layout';
 import { apiGet, apiPost } from '@/components/useApi';
 
@@ -7,14 +7,26 @@ export default function Dashboard(){
   const [email, setEmail] = useState('');
   const [shadow, setShadow] = useState(true);
   const [batchResult, setBatchResult] = useState(null);
+  const [live, setLive] = useState('');
 
-  async function loadMode(){ const m = await apiGet(`mode?email=${encodeURIComponent(email)}`); setShadow(!!m.shadow); }
+  async function loadMode(){ const m = await apiGet(`mode?email=${encodeURIComponent(email)}`); setShadow(!!m.shadow); setLive(email); }
   async function saveMode(v){ const r = await apiPost('mode', { email, shadow: v }); setShadow(r.shadow); }
   async function runBatch(dry=true){
     const r = await apiPost('gmail/batch-classify', { email, label: 'INBOX', max_results: 25, quarantine_threshold: 0.7, dry_run: dry });
     setBatchResult(r);
   }
 
+  useEffect(()=>{
+    // results of scheduled and push-triggered sweeps show up without another run
+    if (!live) return;
+    const es = new EventSource(`/api/sift/events?email=${encodeURIComponent(live)}`);
+    es.addEventListener('classified', e=>{
+      const r = JSON.parse(e.data);
+      if (r.items && r.items.length) setBatchResult(r);  // keep the last results when a sweep found nothing new
+    });
+    return ()=>es.close();
+  }, [live]);
+
   return (
     <Layout>
       <section className="container" style={{padding:'36px 0'}}>